@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# vim:ts=4:sts=4:sw=4:tw=80:et
+
+"""
+Benchmarks for timetrack. Runs against a throw-away database and config in a
+temporary directory, never against your real data.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TIMETRACK = os.path.join(HERE, 'timetrack.py')
+
+
+def makeHome(tmpdir, dbfile):
+    """
+    Create a fake $HOME with a timetrack config pointing to dbfile and return
+    an environment using it.
+    """
+    home = os.path.join(tmpdir, 'home')
+    os.makedirs(os.path.join(home, '.config'), exist_ok=True)
+    with open(os.path.join(home, '.config', 'timetrack.conf'), 'w') as f:
+        f.write("[db]\nfile = {}\n".format(dbfile))
+        f.write("[calendar]\ncache = {}\n".format(
+            os.path.join(tmpdir, 'calendar.json')))
+
+    env = dict(os.environ)
+    env['HOME'] = home
+    return env
+
+
+def timeCommand(env, argv, stdin=None):
+    start = time.perf_counter()
+    subprocess.run(argv, env=env, input=stdin, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, text=True, cwd=HERE)
+    return time.perf_counter() - start
+
+
+def printTimings(name, timings):
+    print("{:<24} min {:7.1f} ms   median {:7.1f} ms".format(name,
+          min(timings) * 1000, statistics.median(timings) * 1000))
+
+
+def benchStartup(args):
+    """
+    Wall clock time of complete timetrack invocations for the punch commands,
+    compared to a bare interpreter start.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = makeHome(tmpdir, os.path.join(tmpdir, 'times.db'))
+
+        timings = [timeCommand(env, [sys.executable, '-c', 'pass'])
+                   for i in range(args.runs)]
+        printTimings('python -c pass', timings)
+
+        daemon = None
+        if args.daemon:
+            with open(os.path.join(env['HOME'], '.config', 'timetrack.conf'),
+                      'a') as f:
+                f.write("[daemon]\nsocket = {}\n".format(
+                    os.path.join(tmpdir, 'timetrack.sock')))
+            daemon = subprocess.Popen([sys.executable, TIMETRACK, 'serve'],
+                                      env=env, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL, text=True)
+            # wait for "Serving on ..."
+            daemon.stdout.readline()
+
+        # a second "start" after "end" asks whether to return to work
+        cycle = ['start', 'break', 'resume', 'end']
+        results = {cmd: [] for cmd in cycle}
+        for i in range(args.runs):
+            for cmd in cycle:
+                results[cmd].append(timeCommand(
+                    env, [sys.executable, TIMETRACK, cmd], stdin='y\n'))
+        for cmd in cycle:
+            printTimings('timetrack ' + cmd, results[cmd])
+
+        timings = [timeCommand(env, [sys.executable, TIMETRACK, 'day'])
+                   for i in range(args.runs)]
+        printTimings('timetrack day', timings)
+
+        timings = [timeCommand(env, [sys.executable, TIMETRACK, '--help'])
+                   for i in range(args.runs)]
+        printTimings('timetrack --help', timings)
+
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+
+
+def generateDatabase(timetrack, years, seed=1):
+    """
+    Fill the configured database with a synthetic punch history of the given
+    number of years, ending yesterday. Returns the first day of the history.
+    """
+    rnd = random.Random(seed)
+    today = date.today()
+    firstDay = date(today.year - years, today.month, 1)
+
+    def at(day, hour, minute):
+        return datetime(day.year, day.month, day.day, hour, minute,
+                        rnd.randrange(60), rnd.randrange(1000000))
+
+    entries = []
+    day = firstDay
+    while day < today:
+        if timetrack.holiday_calendar.is_working_day(day):
+            r = rnd.random()
+            if r < 0.03:
+                entries.append((timetrack.ACT_SICK, at(day, 0, 0)))
+            elif r < 0.08:
+                entries.append((timetrack.ACT_VACATION, at(day, 0, 0)))
+            elif r < 0.09:
+                entries.append((timetrack.ACT_FZA, at(day, 0, 0)))
+            else:
+                entries.append((timetrack.ACT_ARRIVE,
+                                at(day, rnd.randrange(7, 10), rnd.randrange(60))))
+                hour = 11
+                for i in range(rnd.randrange(4)):
+                    entries.append((timetrack.ACT_BREAK,
+                                    at(day, hour, rnd.randrange(20))))
+                    entries.append((timetrack.ACT_RESUME,
+                                    at(day, hour, rnd.randrange(30, 59))))
+                    hour += 1
+                # forget to leave now and then
+                if r > 0.11:
+                    entries.append((timetrack.ACT_LEAVE,
+                                    at(day, rnd.randrange(16, 19),
+                                       rnd.randrange(60))))
+        day += timedelta(days=1)
+
+    con = timetrack.dbSetup()
+    timetrack.addEntries(con, entries)
+    con.close()
+    return firstDay
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement):
+        self.count += 1
+
+
+def measure(timetrack, func, args, runs, cold=False):
+    """
+    Run func(con, *args) runs times with stdout discarded. Returns the
+    timings, the number of SQL statements and the peak memory of one run.
+    """
+    def once(trace=None):
+        # open the connection like runAction() does
+        if func in timetrack.REPORT_HANDLERS:
+            con = timetrack.dbOpenReport()
+        else:
+            con = timetrack.dbSetup()
+        if cold:
+            writer = timetrack.writableConnection(con)
+            writer.execute("DELETE FROM month_summary")
+            writer.execute("DELETE FROM ledger")
+            writer.commit()
+        if trace:
+            # the cache writes of reports go through the writer
+            con.set_trace_callback(trace)
+            timetrack.writableConnection(con).set_trace_callback(trace)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(con, *args)
+        elapsed = time.perf_counter() - start
+        timetrack.dbClose(con)
+        return elapsed
+
+    timings = [once() for i in range(runs)]
+
+    counter = QueryCounter()
+    tracemalloc.start()
+    once(counter)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return timings, counter.count, peak
+
+
+def benchReports(args):
+    """
+    Time the report and punch commands in-process against synthetic histories
+    of different lengths.
+    """
+    sys.path.insert(0, HERE)
+    import timetrack
+
+    # punch commands ask before returning to work after leaving
+    timetrack.input = lambda prompt: 'y'
+
+    today = date.today()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timetrack.holiday_calendar.cacheFile = os.path.join(tmpdir,
+                                                            'calendar.json')
+        for years in args.years:
+            dbfile = os.path.join(tmpdir, 'times-{}.db'.format(years))
+            timetrack.cfg.read_dict({'db': {'file': dbfile}})
+            timetrack.THE_START = generateDatabase(timetrack, years)
+
+            benchmarks = [
+                ('day', timetrack.dayStatistics, (-1,), False),
+                ('week', timetrack.weekStatistics, (-1,), False),
+                ('month', timetrack.printMonthStats,
+                 (today.month, today.year), False),
+                ('month ytd+total (cold)', timetrack.printMonthStats,
+                 (today.month, today.year, True, True), True),
+                ('year (cold)', timetrack.printYearlyStats,
+                 (today.year - 1,), True),
+                ('year', timetrack.printYearlyStats, (today.year - 1,), False),
+                ('total (cold)', timetrack.printTotalStats,
+                 (today.year, today.month - 1), True),
+                ('total', timetrack.printTotalStats,
+                 (today.year, today.month - 1), False),
+                ('punch cycle', punchCycle(timetrack), (), False),
+            ]
+            for name, func, funcArgs, cold in benchmarks:
+                key = "{}y {}".format(years, name)
+                timings, queries, peak = measure(timetrack, func, funcArgs,
+                                                 args.runs, cold)
+                results[key] = {
+                    'min_ms': min(timings) * 1000,
+                    'median_ms': statistics.median(timings) * 1000,
+                    'queries': queries,
+                    'peak_kib': peak / 1024,
+                }
+
+    printResults(results, loadResults(args.compare))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': gitCommit(), 'results': results}, f, indent=2)
+
+
+def punchCycle(timetrack):
+    def cycle(con):
+        timetrack.startTracking(con)
+        timetrack.suspendTracking(con)
+        timetrack.resumeTracking(con)
+        timetrack.endTracking(con)
+    return cycle
+
+
+def loadTimetrack(dbfile, journalMode):
+    """
+    Import timetrack in a worker process and point it to dbfile.
+    """
+    sys.path.insert(0, HERE)
+    import timetrack
+    timetrack.cfg.read_dict({'db': {'file': dbfile,
+                                    'journal_mode': journalMode}})
+    timetrack.input = lambda prompt: 'y'
+    return timetrack
+
+
+def hammerWriter(dbfile, journalMode, user, deadline, results):
+    """
+    Punch start/break/resume/end for user until deadline, recording the
+    latency of every punch and the punches that failed.
+    """
+    timetrack = loadTimetrack(dbfile, journalMode)
+    con = timetrack.dbSetup(user)
+    commands = [timetrack.startTracking, timetrack.suspendTracking,
+                timetrack.resumeTracking, timetrack.endTracking]
+    latencies = []
+    failed = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        while time.time() < deadline:
+            for command in commands:
+                start = time.perf_counter()
+                try:
+                    command(con)
+                except (timetrack.ProgramAbortError, sqlite3.OperationalError):
+                    failed += 1
+                latencies.append(time.perf_counter() - start)
+    con.close()
+    results.put(('writer', latencies, failed))
+
+
+def hammerReader(dbfile, journalMode, deadline, results):
+    """
+    Run cold total reports until deadline, so long read transactions overlap
+    the punches.
+    """
+    timetrack = loadTimetrack(dbfile, journalMode)
+    today = date.today()
+    latencies = []
+    failed = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                con = timetrack.dbOpenReport()
+                writer = timetrack.writableConnection(con)
+                writer.execute("DELETE FROM month_summary")
+                writer.execute("DELETE FROM ledger")
+                writer.commit()
+                timetrack.printTotalStats(con, today.year, today.month - 1)
+                timetrack.dbClose(con)
+            except (timetrack.ProgramAbortError, sqlite3.OperationalError):
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+    results.put(('reader', latencies, failed))
+
+
+def benchConcurrency(args):
+    """
+    Hammer one database from several writer and reader processes at once and
+    report punch latencies and failures per journal mode.
+    """
+    sys.path.insert(0, HERE)
+    import timetrack
+
+    for journalMode in args.journal_mode:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dbfile = os.path.join(tmpdir, 'times.db')
+            timetrack.cfg.read_dict({'db': {'file': dbfile,
+                                            'journal_mode': journalMode}})
+            timetrack.holiday_calendar.cacheFile = os.path.join(
+                tmpdir, 'calendar.json')
+            generateDatabase(timetrack, args.years)
+
+            results = multiprocessing.Queue()
+            deadline = time.time() + args.seconds
+            workers = [multiprocessing.Process(target=hammerWriter,
+                       args=(dbfile, journalMode, 'writer{}'.format(i),
+                             deadline, results))
+                       for i in range(args.writers)]
+            workers += [multiprocessing.Process(target=hammerReader,
+                        args=(dbfile, journalMode, deadline, results))
+                        for i in range(args.readers)]
+            for worker in workers:
+                worker.start()
+            collected = {'writer': ([], 0), 'reader': ([], 0)}
+            for worker in workers:
+                kind, latencies, failed = results.get()
+                collected[kind] = (collected[kind][0] + latencies,
+                                   collected[kind][1] + failed)
+            for worker in workers:
+                worker.join()
+
+            for kind, name in [('writer', 'punch'), ('reader', 'total report')]:
+                latencies, failed = collected[kind]
+                if not latencies:
+                    continue
+                latencies.sort()
+                print("{:<8} {:<14} {:6d} runs {:4d} failed   median {:7.1f} ms"
+                      "   p99 {:7.1f} ms   max {:7.1f} ms".format(
+                      journalMode, name, len(latencies), failed,
+                      statistics.median(latencies) * 1000,
+                      latencies[int(len(latencies) * 0.99)] * 1000,
+                      latencies[-1] * 1000))
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def loadResults(path):
+    if not path:
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    print("comparing against {} ({})".format(path, data.get('commit')))
+    return data['results']
+
+
+def printResults(results, baseline=None):
+    print("{:<32} {:>10} {:>10} {:>8} {:>10}".format(
+        'benchmark', 'min ms', 'median ms', 'queries', 'peak KiB'))
+    for key, r in results.items():
+        line = "{:<32} {:>10.1f} {:>10.1f} {:>8d} {:>10.0f}".format(
+            key, r['min_ms'], r['median_ms'], r['queries'], r['peak_kib'])
+        if baseline and key in baseline:
+            b = baseline[key]
+            line += "   {:+6.0%} time {:+d} queries {:+6.0%} memory".format(
+                r['min_ms'] / b['min_ms'] - 1, r['queries'] - b['queries'],
+                r['peak_kib'] / b['peak_kib'] - 1)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark timetrack')
+    commands = parser.add_subparsers(title='benchmarks', dest='action',
+                                     metavar='benchmark')
+    commands.required = True
+
+    parser_startup = commands.add_parser('startup',
+                                         help='Time punch command startup')
+    parser_startup.add_argument('--runs', type=int, default=20,
+                                help='Number of runs per command')
+    parser_startup.add_argument('--daemon', action='store_true',
+                                help='Run the commands through "timetrack '
+                                'serve"')
+    parser_startup.set_defaults(func=benchStartup)
+
+    parser_reports = commands.add_parser('reports',
+                                         help='Time reports on synthetic data')
+    parser_reports.add_argument('--years', type=int, nargs='+',
+                                default=[1, 5, 20],
+                                help='History lengths to generate')
+    parser_reports.add_argument('--runs', type=int, default=3,
+                                help='Number of timed runs per benchmark')
+    parser_reports.add_argument('--output', '-o',
+                                help='Write results as JSON to this file')
+    parser_reports.add_argument('--compare',
+                                help='JSON results of an earlier run to '
+                                'compare against')
+    parser_reports.set_defaults(func=benchReports)
+
+    parser_concurrency = commands.add_parser('concurrency',
+                                             help='Punch while reports run in '
+                                             'other processes')
+    parser_concurrency.add_argument('--writers', type=int, default=4,
+                                    help='Number of punching processes')
+    parser_concurrency.add_argument('--readers', type=int, default=2,
+                                    help='Number of processes running reports')
+    parser_concurrency.add_argument('--seconds', type=float, default=10,
+                                    help='How long to hammer the database')
+    parser_concurrency.add_argument('--years', type=int, default=5,
+                                    help='History length to generate')
+    parser_concurrency.add_argument('--journal-mode', dest='journal_mode',
+                                    nargs='+', default=['delete', 'wal'],
+                                    help='Journal modes to compare')
+    parser_concurrency.set_defaults(func=benchConcurrency)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# vim:ts=4:sts=4:sw=4:tw=80:et
+
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import os
+
+
+def cleanedDate(day):
+    if isinstance(day, datetime):
+        return day.date()
+    return day
+
+
+class YearCalendar:
+    """
+    Precomputed calendar of a single year: a bitset with bit n set if the n-th
+    day of the year (0-based) is a working day, and the holiday labels by date.
+    """
+    __slots__ = ('year', 'first', 'working', 'labels')
+
+    def __init__(self, year, working, labels):
+        self.year = year
+        self.first = date(year, 1, 1).toordinal()
+        self.working = working
+        self.labels = labels
+
+    @classmethod
+    def compute(cls, calendar, year):
+        # same semantics as workalendar's get_holiday_label: last label wins
+        labels = {day: label for day, label in calendar.holidays(year)}
+
+        working = 0
+        day = date(year, 1, 1)
+        i = 0
+        while day.year == year:
+            if calendar.is_working_day(day):
+                working |= 1 << i
+            day += timedelta(days=1)
+            i += 1
+        return cls(year, working, labels)
+
+    def index(self, day):
+        return day.toordinal() - self.first
+
+    def is_working_day(self, day):
+        return bool((self.working >> self.index(day)) & 1)
+
+    def countWorkingDays(self, first, last):
+        """
+        Number of working days from first to last, both inclusive.
+        """
+        i = self.index(first)
+        n = self.index(last) - i + 1
+        return ((self.working >> i) & ((1 << n) - 1)).bit_count()
+
+    def toJson(self):
+        return {
+            'working': "{:x}".format(self.working),
+            'labels': {day.isoformat(): label
+                       for day, label in self.labels.items()},
+        }
+
+    @classmethod
+    def fromJson(cls, year, data):
+        return cls(year, int(data['working'], 16),
+                   {date.fromisoformat(day): label
+                    for day, label in data['labels'].items()})
+
+
+class CalendarCache:
+    """
+    Drop-in replacement for the subset of the workalendar calendar API used by
+    timetrack, answering all queries from per-year YearCalendar objects. The
+    calendar itself is only instantiated by calling factory when a year is
+    neither in memory nor in the optional cache file.
+    """
+    def __init__(self, name, factory, cacheFile=None, maxYears=32):
+        self.name = name
+        self.factory = factory
+        self.cacheFile = cacheFile
+        self.maxYears = maxYears
+        self.calendar = None
+        self.years = OrderedDict()
+        self.persisted = None
+
+    def _loadPersisted(self):
+        self.persisted = {}
+        if not self.cacheFile:
+            return
+        import json
+        try:
+            with open(self.cacheFile) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('calendar') == self.name:
+            self.persisted = data.get('years', {})
+
+    def _savePersisted(self):
+        if not self.cacheFile:
+            return
+        import json
+        data = {'calendar': self.name, 'years': self.persisted}
+        # per process, report workers may save at the same time
+        tmpFile = "{}.{}.tmp".format(self.cacheFile, os.getpid())
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpFile, self.cacheFile)
+        except OSError:
+            # the cache is optional, failing to write it is not an error
+            pass
+
+    def year(self, year):
+        yc = self.years.get(year)
+        if yc is not None:
+            self.years.move_to_end(year)
+            return yc
+
+        if self.persisted is None:
+            self._loadPersisted()
+
+        key = str(year)
+        if key in self.persisted:
+            yc = YearCalendar.fromJson(year, self.persisted[key])
+        else:
+            if self.calendar is None:
+                self.calendar = self.factory()
+            yc = YearCalendar.compute(self.calendar, year)
+            self.persisted[key] = yc.toJson()
+            self._savePersisted()
+
+        self.years[year] = yc
+        if len(self.years) > self.maxYears:
+            self.years.popitem(last=False)
+        return yc
+
+    def is_working_day(self, day):
+        day = cleanedDate(day)
+        return self.year(day.year).is_working_day(day)
+
+    def is_holiday(self, day):
+        day = cleanedDate(day)
+        return day in self.year(day.year).labels
+
+    def get_holiday_label(self, day):
+        day = cleanedDate(day)
+        return self.year(day.year).labels.get(day)
+
+    def countWorkingDays(self, first, last):
+        """
+        Number of working days from first to last, both inclusive.
+        """
+        count = 0
+        while first <= last:
+            yearEnd = min(last, date(first.year, 12, 31))
+            count += self.year(first.year).countWorkingDays(first, yearEnd)
+            first = yearEnd + timedelta(days=1)
+        return count
+
+    def get_working_days_delta(self, start, end, include_start=False):
+        """
+        Same result as workalendar's get_working_days_delta.
+        """
+        start = cleanedDate(start)
+        end = cleanedDate(end)
+
+        if start == end:
+            return 0
+        if start > end:
+            start, end = end, start
+
+        count = self.countWorkingDays(start + timedelta(days=1), end)
+        if include_start and self.is_working_day(start):
+            count += 1
+        return count
@@ -6,6 +6,9 @@ ACT_SICK = 'sick'
 ACT_VACATION = 'vac'
 ACT_FZA = 'fza'
 
+ACT_ALL = (ACT_ARRIVE, ACT_BREAK, ACT_RESUME, ACT_LEAVE, ACT_SICK, ACT_VACATION,
+           ACT_FZA)
+
 
 
 MSG_ERR_NOT_WORKING = 1 << 0
@@ -0,0 +1,100 @@
+# vim:ts=4:sts=4:sw=4:tw=80:et
+
+from array import array
+from bisect import bisect_right
+from datetime import date
+from itertools import accumulate
+
+
+class ExpectedHours:
+    """
+    Expected work time per day from first on: the weekly hours of the schedule
+    in effect, spread over five days, on every working day of calendar, a
+    CalendarCache. The days of a year are computed at once into prefix sums,
+    so the expected time of a range is the difference of two of them per year
+    it touches.
+
+    schedule is a list of (since, weekHours) ordered by since, weekHours is
+    what applies before its first entry.
+    """
+    def __init__(self, calendar, first, schedule, weekHours):
+        self.calendar = calendar
+        self.first = first
+        self.schedule = schedule
+        self.since = [since.toordinal() for since, hours in schedule]
+        self.weekHours = weekHours
+        # per year: element i is the sum of the first i days of the year
+        self.years = {}
+
+    def _rate(self, i):
+        hours = self.schedule[i - 1][1] if i else self.weekHours
+        return round(hours * 3600 / 5)
+
+    def dailySeconds(self, day):
+        """
+        Seconds per working day of the schedule in effect on day, whether day
+        is a working day or not.
+        """
+        return self._rate(bisect_right(self.since, day.toordinal()))
+
+    def _rates(self, first, count):
+        """
+        dailySeconds() of count days from first on, a run per schedule entry.
+        """
+        rates = []
+        day = first.toordinal()
+        end = day + count
+        i = bisect_right(self.since, day)
+        while day < end:
+            runEnd = min(self.since[i], end) if i < len(self.since) else end
+            rates.extend([self._rate(i)] * (runEnd - day))
+            day = runEnd
+            i += 1
+        return rates
+
+    def _year(self, year):
+        prefix = self.years.get(year)
+        if prefix is None:
+            # from the calendar's working day bitset, nothing before first
+            yc = self.calendar.year(year)
+            count = yc.index(date(year, 12, 31)) + 1
+            working = "{:b}".format(yc.working)[::-1].ljust(count, '0')
+            values = [rate if bit == '1' else 0 for rate, bit
+                      in zip(self._rates(date(year, 1, 1), count), working)]
+            if year == self.first.year:
+                skip = yc.index(self.first)
+                values[:skip] = [0] * skip
+            prefix = self.years[year] = array('q', accumulate(values,
+                                                               initial=0))
+        return prefix
+
+    def seconds(self, firstDay, lastDay):
+        """
+        Expected seconds from firstDay to lastDay, both inclusive. Days before
+        first don't count.
+        """
+        firstDay = max(firstDay, self.first)
+        total = 0
+        while firstDay <= lastDay:
+            yearEnd = min(lastDay, date(firstDay.year, 12, 31))
+            prefix = self._year(firstDay.year)
+            total += (prefix[yearEnd.timetuple().tm_yday] -
+                      prefix[firstDay.timetuple().tm_yday - 1])
+            firstDay = date(firstDay.year + 1, 1, 1)
+        return total
+
+    def daySeconds(self, firstDay, lastDay):
+        """
+        Expected seconds of every day from firstDay, not before first, to
+        lastDay as a list.
+        """
+        firstDay = max(firstDay, self.first)
+        values = []
+        while firstDay <= lastDay:
+            yearEnd = min(lastDay, date(firstDay.year, 12, 31))
+            prefix = self._year(firstDay.year)
+            values.extend(prefix[i] - prefix[i - 1] for i in
+                          range(firstDay.timetuple().tm_yday,
+                                yearEnd.timetuple().tm_yday + 1))
+            firstDay = date(firstDay.year + 1, 1, 1)
+        return values
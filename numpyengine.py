@@ -0,0 +1,117 @@
+# vim:ts=4:sts=4:sw=4:tw=80:et
+
+"""
+Vectorized work time computation on NumPy arrays. Produces the same per-day
+worktimes as WorkDay.worktime() for the entries of a date range; days this
+engine cannot reproduce exactly make dayWorktimes() return None so the caller
+can fall back to the WorkDay based computation.
+
+Requires numpy, which is optional for timetrack.
+"""
+
+import numpy as np
+
+# type codes of the event stream: the index of the type in ACT_ALL
+ARRIVE, BREAK, RESUME, LEAVE, SICK, VACATION, FZA = range(7)
+
+MINUTE_US = 60 * 1000000
+DAY_US = 24 * 60 * MINUTE_US
+
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def parseTimestamps(strings):
+    """
+    Convert ISO timestamps as stored by sqlite3 to int64 microseconds since
+    1970-01-01 (naive, like the stored values).
+    """
+    return np.array(strings, dtype='datetime64[us]').astype(np.int64)
+
+
+def dayWorktimes(tsUs, codes, firstDayNum, numDays, nowUs, specialUs):
+    """
+    Compute the worktime in microseconds, floored to minutes, of numDays days
+    starting at day number firstDayNum (days since 1970-01-01).
+
+    tsUs and codes hold all events of those days ordered by time, specialUs is
+    the time credited for a sick or vacation day, either a scalar or one value
+    per day. Returns an int64 array with one value per day or None if the
+    events contain something only the WorkDay code handles (unknown types,
+    breaks and resumes out of order, special entries after an arrival).
+    """
+    tsUs = np.asarray(tsUs, dtype=np.int64)
+    codes = np.asarray(codes, dtype=np.int8)
+    specialUs = np.broadcast_to(np.asarray(specialUs, dtype=np.int64),
+                                (numDays,))
+
+    if np.any(codes < 0):
+        return None
+
+    day = tsUs // DAY_US - firstDayNum
+    dayStart = (firstDayNum + np.arange(numDays, dtype=np.int64)) * DAY_US
+    isToday = np.arange(numDays) == nowUs // DAY_US - firstDayNum
+
+    # a day counts from its first arrival on, see dayEntries()
+    isArrive = codes == ARRIVE
+    firstArrive = np.full(numDays, INT64_MAX, dtype=np.int64)
+    np.minimum.at(firstArrive, day[isArrive], tsUs[isArrive])
+    hasArrive = firstArrive != INT64_MAX
+
+    keep = tsUs >= firstArrive[day]
+    kTs = tsUs[keep]
+    kCodes = codes[keep]
+    kDay = day[keep]
+
+    # a special entry after the arrival turns the day into a special day,
+    # including the pauses recorded before it - leave that to WorkDay
+    if np.any(kCodes >= SICK):
+        return None
+
+    # breaks and resumes have to alternate, starting with a break
+    isPause = (kCodes == BREAK) | (kCodes == RESUME)
+    pTs = kTs[isPause]
+    pCodes = kCodes[isPause]
+    pDay = kDay[isPause]
+    pos = np.arange(len(pDay)) - np.searchsorted(pDay, pDay, side='left')
+    if np.any(pCodes != np.where(pos % 2 == 0, BREAK, RESUME)):
+        return None
+
+    # every resume closes the break right before it; a break still open at
+    # the end of the day is not a pause (yet)
+    resumes = np.nonzero(pCodes == RESUME)[0]
+    pauseUs = np.zeros(numDays, dtype=np.int64)
+    np.add.at(pauseUs, pDay[resumes], pTs[resumes] - pTs[resumes - 1])
+
+    # the last arrival and the last leave win
+    start = dayStart.copy()
+    np.maximum.at(start, day[isArrive], tsUs[isArrive])
+    isLeave = kCodes == LEAVE
+    end = dayStart.copy()
+    np.maximum.at(end, kDay[isLeave], kTs[isLeave])
+    finished = np.zeros(numDays, dtype=bool)
+    finished[kDay[isLeave]] = True
+
+    # today counts up to now, or up to the start of a break still open
+    openBreak = np.full(numDays, INT64_MAX, dtype=np.int64)
+    breaks = np.nonzero(pCodes == BREAK)[0]
+    isOpen = pos[breaks] == np.bincount(pDay, minlength=numDays)[pDay[breaks]] - 1
+    openBreak[pDay[breaks[isOpen]]] = pTs[breaks[isOpen]]
+
+    unfinishedToday = isToday & hasArrive & ~finished
+    total = (np.where(unfinishedToday, np.minimum(nowUs, openBreak), end) -
+             start - pauseUs)
+    # don't count incomplete days unless it's today
+    total = np.where(finished | unfinishedToday, total, 0)
+
+    # days without arrival take the type of their first special entry
+    isSpecial = codes >= SICK
+    spDays, firstIdx = np.unique(day[isSpecial], return_index=True)
+    spCodes = codes[isSpecial][firstIdx]
+    withoutArrive = ~hasArrive[spDays]
+    spDays = spDays[withoutArrive]
+    spCodes = spCodes[withoutArrive]
+
+    # special days are credited their daily hours, today as well
+    total[spDays] = np.where(spCodes == FZA, 0, specialUs[spDays])
+
+    return total - total % MINUTE_US
@@ -0,0 +1,135 @@
+# vim:ts=4:sts=4:sw=4:tw=80:et
+
+"""
+Opt-in SQL instrumentation for timetrack, enabled with --profile or the
+TIMETRACK_PROFILE environment variable. Only imported when enabled, so it
+costs nothing otherwise.
+"""
+
+import sqlite3
+import sys
+from time import perf_counter
+
+
+class QueryStats:
+    """
+    Number of executions and accumulated time per query shape. The shape is
+    the SQL text with whitespace collapsed; parameters are bound separately,
+    so all executions of a statement share it.
+    """
+    def __init__(self):
+        self.shapes = {}
+
+    def record(self, sql, elapsed, count=1):
+        shape = " ".join(sql.split())
+        stats = self.shapes.get(shape)
+        if stats is None:
+            stats = self.shapes[shape] = [0, 0.0]
+        stats[0] += count
+        stats[1] += elapsed
+
+    def merge(self, other):
+        for shape, (count, elapsed) in other.shapes.items():
+            self.record(shape, elapsed, count)
+
+    def report(self, top=10, file=sys.stderr):
+        statements = sum(s[0] for s in self.shapes.values())
+        elapsed = sum(s[1] for s in self.shapes.values())
+        print("SQL: {} statements, {} shapes, {:.1f} ms".format(
+              statements, len(self.shapes), elapsed * 1000), file=file)
+
+        hottest = sorted(self.shapes.items(), key=lambda i: i[1][1],
+                         reverse=True)[:top]
+        print("  {:>6} {:>9} {:>8}   {}".format('count', 'total ms', 'avg ms',
+                                                'query'), file=file)
+        for shape, (count, total) in hottest:
+            if len(shape) > 70:
+                shape = shape[:67] + "..."
+            print("  {:>6d} {:>9.2f} {:>8.3f}   {}".format(count, total * 1000,
+                  total * 1000 / count, shape), file=file)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor adding the time spent fetching rows to the shape that produced
+    them.
+    """
+    def _timed(self, method, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.connection.profile.record(self.shape, perf_counter() - start,
+                                           count=0)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+
+def profilingConnection(base):
+    """
+    Return a subclass of the connection class base recording every statement
+    in a QueryStats object, available as the profile attribute. base is
+    passed in rather than imported, timetrack usually runs as __main__.
+    """
+    class ProfilingConnection(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.profile = QueryStats()
+
+        def _run(self, method, sql, parameters):
+            cur = self.cursor(ProfilingCursor)
+            cur.shape = sql
+            start = perf_counter()
+            try:
+                return getattr(cur, method)(sql, parameters)
+            finally:
+                self.profile.record(sql, perf_counter() - start)
+
+        def execute(self, sql, parameters=()):
+            return self._run('execute', sql, parameters)
+
+        def executemany(self, sql, parameters):
+            return self._run('executemany', sql, parameters)
+
+        def commit(self):
+            start = perf_counter()
+            try:
+                super().commit()
+            finally:
+                self.profile.record("COMMIT", perf_counter() - start)
+
+    return ProfilingConnection
+
+
+def run(handler, con, kwargs, dumpFile=None):
+    """
+    Run handler(con, **kwargs), then print the SQL statistics of con and its
+    writer, if one was opened, to stderr. With dumpFile, the handler runs
+    under cProfile and the stats are written to that file for
+    pstats/snakeviz.
+    """
+    profiler = None
+    try:
+        if dumpFile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.runcall(handler, con, **kwargs)
+        else:
+            handler(con, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(dumpFile)
+        stats = con.profile
+        if con.writer is not None and con.writer is not con:
+            stats.merge(con.writer.profile)
+        stats.report()
@@ -2,21 +2,28 @@
 # vim:ts=4:sts=4:sw=4:tw=80:et
 
 from datetime import datetime, date, time, timedelta
-from dateutil.relativedelta import *
 
-import argparse
 import os
 import sqlite3
 import sys
 import configparser
+import functools
+import random
 from enum import Enum, auto
-from functools import reduce
-from workalendar.europe.germany import Berlin
-import calendar
-import decimal
-from decimal import Decimal
+from array import array
 
-holiday_calendar = Berlin()
+# Keep the module level imports cheap: the punch commands are run from shell
+# hooks all day long and need neither argparse, decimal nor workalendar.
+# Those are imported where they are used.
+
+from calendarcache import CalendarCache, cleanedDate
+from expectedhours import ExpectedHours
+
+def berlinCalendar():
+    from workalendar.europe.germany import Berlin
+    return Berlin()
+
+holiday_calendar = CalendarCache('Berlin', berlinCalendar)
 
 
 from defines import *
@@ -24,12 +31,22 @@ from randommessage import *
 
 cfg = configparser.ConfigParser()
 
-THE_START = date(2021, 7, 12)
+class Connection(sqlite3.Connection):
+    """
+    Connection knowing the user whose entries all queries work on, see
+    dbSetup(), and whether it may write, see dbOpenReadOnly().
+    """
+    user = ''
+    readonly = False
+    writer = None
 
-# monthly reporting as decimal hours we round as expected
-decimal.getcontext().rounding = decimal.ROUND_HALF_UP
+# replaced by a sqlprofile subclass when profiling, see runAction()
+connectionFactory = Connection
+
+THE_START = date(2021, 7, 12)
 
 def valid_cli_date(s):
+    import argparse
     try:
         return datetime.strptime(s, "%Y-%m-%d")
     except ValueError:
@@ -72,19 +89,89 @@ def error(msg, ex):
     """
     raise ProgramAbortError(msg, ex)
 
-def dbSetup():
+
+class NeedsTerminal(Exception):
+    """
+    Raised by ask() inside the daemon, where there is nobody to answer. The
+    client runs the command itself then.
+    """
+
+
+# set while running as daemon, see serveDaemon()
+serving = False
+
+def ask(prompt):
+    """
+    Ask the user a question on the terminal and return the answer.
+    """
+    if serving:
+        raise NeedsTerminal(prompt)
+    return input(prompt)
+
+def defaultUser():
+    """
+    The user to work on without --user: "[db] user" from the config, or the
+    empty name single-user databases use.
+    """
+    return cfg.get('db', 'user', fallback='')
+
+# allowed values of the [db] journal_mode and synchronous options
+JOURNAL_MODES = ('wal', 'delete', 'truncate', 'persist', 'memory')
+SYNCHRONOUS_MODES = ('off', 'normal', 'full', 'extra')
+
+def dbOption(name, allowed, fallback):
+    value = cfg.get('db', name, fallback=fallback).lower()
+    if value not in allowed:
+        error("Invalid [db] {} {!r}, use one of {}".format(name, value,
+              ", ".join(allowed)), None)
+    return value
+
+def busyTimeout():
+    """
+    Seconds to wait for another process to release the database, set in
+    milliseconds as "[db] busy_timeout".
+    """
+    return cfg.getint('db', 'busy_timeout', fallback=5000) / 1000
+
+def beginUpgrade(con, version):
+    """
+    Lock the database for the schema upgrade to version. Returns False, with
+    the lock released again, if another process did it in the meantime.
+    """
+    con.execute("BEGIN EXCLUSIVE")
+    if con.execute("PRAGMA user_version").fetchone()[0] >= version:
+        con.commit()
+        return False
+    return True
+
+def dbSetup(user=None):
     """
     Create a new SQLite database in the user's home, creating and initializing
-    the database if it doesn't exist. Returns an sqlite3 connection object.
+    the database if it doesn't exist. Returns an sqlite3 connection object
+    with the user attribute set to user, or defaultUser().
     """
     con = sqlite3.connect(os.path.expanduser(cfg['db']['file']),
-                          detect_types=sqlite3.PARSE_DECLTYPES)
+                          detect_types=sqlite3.PARSE_DECLTYPES,
+                          timeout=busyTimeout(),
+                          factory=connectionFactory)
     con.row_factory = sqlite3.Row
+    con.user = defaultUser() if user is None else user
+    con.readonly = False
+    con.writer = None
+
+    # in WAL mode readers (reports, watch) never block a punch and vice versa
+    try:
+        con.execute("PRAGMA journal_mode = {}".format(
+                    dbOption('journal_mode', JOURNAL_MODES, 'wal')))
+    except sqlite3.OperationalError:
+        # switching needs the database for itself, try again next time
+        pass
+    con.execute("PRAGMA synchronous = {}".format(
+                dbOption('synchronous', SYNCHRONOUS_MODES, 'normal')))
 
     dbVersion = con.execute("PRAGMA user_version").fetchone()['user_version']
-    if dbVersion == 0:
+    if dbVersion == 0 and beginUpgrade(con, 1):
         # database is uninitialized, create the tables we need
-        con.execute("BEGIN EXCLUSIVE")
         con.execute("""
                 CREATE TABLE times (
                       type TEXT NOT NULL CHECK (
@@ -102,62 +189,352 @@ def dbSetup():
                 ACT_VACATION, ACT_FZA))
         con.execute("PRAGMA user_version = 1")
         con.commit()
-    # database upgrade code would go here
+        dbVersion = 1
+
+    if dbVersion < 2 and beginUpgrade(con, 2):
+        # cache for the aggregates of finished months, see cachedMonthStats()
+        con.execute("""
+                CREATE TABLE month_summary (
+                      month DATE NOT NULL PRIMARY KEY
+                    , expected INTEGER NOT NULL
+                    , actual INTEGER NOT NULL
+                    , workdays INTEGER NOT NULL
+                    , worktimes TEXT NOT NULL
+                )
+            """)
+        con.execute("PRAGMA user_version = 2")
+        con.commit()
+        dbVersion = 2
+
+    if dbVersion < 3 and beginUpgrade(con, 3):
+        # the primary key leads on type, so lookups by time need their own
+        # index; including type makes it covering for all our queries
+        con.execute("CREATE INDEX times_ts ON times (ts, type)")
+        con.execute("PRAGMA user_version = 3")
+        con.commit()
+        dbVersion = 3
+
+    if dbVersion < 4 and beginUpgrade(con, 4):
+        # several users share one database: rebuild times with a user column
+        # leading key and index, existing entries belong to user ''. The
+        # month summaries are a cache and just start over.
+        con.execute("""
+                CREATE TABLE times_v4 (
+                      user TEXT NOT NULL DEFAULT ''
+                    , type TEXT NOT NULL CHECK (type IN ({}))
+                    , ts TIMESTAMP NOT NULL
+                    , PRIMARY KEY (user, type, ts)
+                )
+            """.format(", ".join("'{}'".format(t) for t in ACT_ALL)))
+        con.execute("INSERT INTO times_v4 (user, type, ts) "
+                    "SELECT '', type, ts FROM times")
+        con.execute("DROP TABLE times")
+        con.execute("ALTER TABLE times_v4 RENAME TO times")
+        con.execute("CREATE INDEX times_user_ts ON times (user, ts, type)")
+        con.execute("DROP TABLE month_summary")
+        con.execute("""
+                CREATE TABLE month_summary (
+                      user TEXT NOT NULL DEFAULT ''
+                    , month DATE NOT NULL
+                    , expected INTEGER NOT NULL
+                    , actual INTEGER NOT NULL
+                    , workdays INTEGER NOT NULL
+                    , worktimes TEXT NOT NULL
+                    , PRIMARY KEY (user, month)
+                )
+            """)
+        con.execute("PRAGMA user_version = 4")
+        con.commit()
+        dbVersion = 4
+
+    if dbVersion < 5 and beginUpgrade(con, 5):
+        # expected and actual seconds per closed day with their running sums
+        # since THE_START, see extendLedger()
+        con.execute("""
+                CREATE TABLE ledger (
+                      user TEXT NOT NULL DEFAULT ''
+                    , day DATE NOT NULL
+                    , expected INTEGER NOT NULL
+                    , actual INTEGER NOT NULL
+                    , cum_expected INTEGER NOT NULL
+                    , cum_actual INTEGER NOT NULL
+                    , PRIMARY KEY (user, day)
+                ) WITHOUT ROWID
+            """)
+        con.execute("PRAGMA user_version = 5")
+        con.commit()
+        dbVersion = 5
 
+    if dbVersion < 6 and beginUpgrade(con, 6):
+        # weekly hours of a user from a day on, WEEK_HOURS before the first
+        # entry, see expectedHours()
+        con.execute("""
+                CREATE TABLE schedule (
+                      user TEXT NOT NULL DEFAULT ''
+                    , since DATE NOT NULL
+                    , week_hours REAL NOT NULL
+                    , PRIMARY KEY (user, since)
+                ) WITHOUT ROWID
+            """)
+        con.execute("PRAGMA user_version = 6")
+        con.commit()
+        dbVersion = 6
+
+    return con
+
+# user_version of a database dbSetup() has nothing to do for
+SCHEMA_VERSION = 6
+
+def dbOpenReadOnly(user=None):
+    """
+    Open the database read-only, e.g. for reports or report workers running
+    next to each other. Reads go through memory mapped I/O ("[db] mmap_size"
+    in bytes) and a larger page cache ("[db] cache_size" in KiB). Unlike
+    dbSetup() this neither creates nor upgrades the database; the few writes
+    of reports go through writableConnection().
+    """
+    from urllib.parse import quote
+    path = os.path.abspath(os.path.expanduser(cfg['db']['file']))
+    con = sqlite3.connect("file:{}?mode=ro".format(quote(path)), uri=True,
+                          detect_types=sqlite3.PARSE_DECLTYPES,
+                          timeout=busyTimeout(),
+                          factory=connectionFactory)
+    con.row_factory = sqlite3.Row
+    con.user = defaultUser() if user is None else user
+    con.readonly = True
+    con.writer = None
+    con.execute("PRAGMA mmap_size = {:d}".format(
+                cfg.getint('db', 'mmap_size', fallback=256 * 1024 * 1024)))
+    con.execute("PRAGMA cache_size = -{:d}".format(
+                cfg.getint('db', 'cache_size', fallback=64 * 1024)))
+    return con
+
+def dbOpenReport(user=None):
+    """
+    Connection for the commands that only read: dbOpenReadOnly(), or
+    dbSetup() if the database doesn't exist yet or needs an upgrade.
+    """
+    try:
+        con = dbOpenReadOnly(user)
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        return dbSetup(user)
+    if version < SCHEMA_VERSION:
+        con.close()
+        return dbSetup(user)
     return con
 
+def writableConnection(con):
+    """
+    Return con if it may write, otherwise a read-write connection for the
+    same user, opened on first use.
+    """
+    if not con.readonly:
+        return con
+    if con.writer is None:
+        con.writer = dbSetup(con.user)
+    return con.writer
 
+def storeCache(con, write):
+    """
+    Run write(writer) on writableConnection(con) and commit, unless it returns
+    False. What it writes is only a cache the next report stores again, so a
+    database that stays locked just skips it. Returns whether it was stored.
+    """
+    writer = writableConnection(con)
+    try:
+        if write(writer) is False:
+            writer.rollback()
+            return False
+        writer.commit()
+        return True
+    except sqlite3.OperationalError:
+        writer.rollback()
+        return False
+
+def dbClose(con):
+    # read-only connections can't checkpoint the WAL, so let the writer be
+    # the last one to close
+    con.close()
+    if con.writer is not None:
+        con.writer.close()
+
+
+def retryLocked(func):
+    """
+    Decorator running func(con, ...) again with exponential backoff while the
+    database stays locked beyond the busy timeout. func must be a complete
+    transaction, it is rolled back before every retry.
+    """
+    @functools.wraps(func)
+    def wrapper(con, *args, **kwargs):
+        delay = 0.05
+        attempts = cfg.getint('db', 'retries', fallback=4)
+        for attempt in range(attempts + 1):
+            try:
+                return func(con, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt == attempts or "locked" not in str(e):
+                    raise
+                con.rollback()
+                warning("Database locked, retrying in {:.2f} s".format(delay))
+                from time import sleep
+                sleep(delay)
+                delay *= 2 * random.uniform(0.8, 1.2)
+    return wrapper
+
+@retryLocked
 def addEntry(con, type, ts):
-    con.execute("INSERT INTO times (type, ts) VALUES (?, ?)", (type, ts))
+    con.execute("INSERT INTO times (user, type, ts) VALUES (?, ?, ?)",
+                (con.user, type, ts))
+    # summaries only exist for closed months and the ledger ends yesterday,
+    # neither is affected by a punch for today
+    if ts.date() < date.today():
+        invalidateMonthSummary(con, ts)
+        updateLedger(con, [ts])
     con.commit()
 
 
-def getLastType(con, date=None):
-    if date:
-        cur = con.execute("SELECT type FROM times WHERE date(ts) = date('{}')"
-        "ORDER BY ts DESC LIMIT 1".format(date))
-    else:
-        cur = con.execute("SELECT type FROM times ORDER BY ts DESC LIMIT 1")
-    row = cur.fetchone()
-    if row is None:
-        return None
-    return row['type']
+def dayRange(d):
+    """
+    Return the half-open timestamp range [start, end) covering the day d, to
+    be used as "ts >= ? AND ts < ?" so the times_user_ts index can be used.
+    """
+    start = datetime.combine(d, time())
+    return (start, start + timedelta(days=1))
 
+# SQL verb per conflict policy of addEntries()
+INSERT_CONFLICT = {
+    'abort':    "INSERT",
+    'ignore':   "INSERT OR IGNORE",
+    'replace':  "INSERT OR REPLACE",
+}
 
-def getLastTime(con):
-    cur = con.execute("SELECT ts FROM times ORDER BY ts DESC LIMIT 1")
-    row = cur.fetchone()
-    if row is None:
-        return None
-    return row['ts']
+def addEntries(con, entries, conflict='abort'):
+    """
+    Insert a batch of (type, ts) entries of con.user in a single transaction.
+    conflict decides about entries that already exist: 'abort' rolls back the
+    whole batch, 'ignore' skips them and 'replace' overwrites them. Returns
+    the number of rows written.
+    """
+    entries = list(entries)
+    if not entries:
+        return 0
+    before = con.total_changes
+    try:
+        con.executemany("{} INTO times (user, type, ts) VALUES (?, ?, ?)"
+                        .format(INSERT_CONFLICT[conflict]),
+                        ((con.user, type, ts) for type, ts in entries))
+        written = con.total_changes - before
+        for month in {date(ts.year, ts.month, 1) for type, ts in entries}:
+            invalidateMonthSummary(con, month)
+        updateLedger(con, [ts for type, ts in entries])
+        con.commit()
+    except sqlite3.IntegrityError as e:
+        con.rollback()
+        error("Could not add entries", e)
+    return written
+
+class CurrentState:
+    """
+    The current tracking state: type and time of the most recent entry plus
+    all entries of today, read with a single query. Commands update it with
+    add() after writing, so it can be handed on to dayStatistics().
+    """
+    def __init__(self, con, day=None):
+        self.day = day if day is not None else date.today()
+        self.entries = []
+        self.lastType = None
+        self.lastTime = None
+
+        start, end = dayRange(self.day)
+        cur = con.execute("SELECT type, ts FROM times WHERE user = ? AND "
+                          "((ts >= ? AND ts < ?) OR "
+                          "ts = (SELECT MAX(ts) FROM times WHERE user = ?)) "
+                          "ORDER BY ts ASC", (con.user, start, end, con.user))
+        for type, ts in cur:
+            if start <= ts < end:
+                self.entries.append((type, ts))
+            self.lastType = type
+            self.lastTime = ts
+
+    def lastTypeToday(self):
+        if not self.entries:
+            return None
+        return self.entries[-1][0]
+
+    def add(self, type, ts):
+        if ts.date() == self.day:
+            self.entries.append((type, ts))
+        self.lastType = type
+        self.lastTime = ts
+
+    def revertLeave(self):
+        """
+        Mirror revertLeave() for today.
+        """
+        self.entries = [(ACT_BREAK if type == ACT_LEAVE else type, ts)
+                        for type, ts in self.entries]
+        if self.lastType == ACT_LEAVE and self.lastTime.date() == self.day:
+            self.lastType = ACT_BREAK
+
+# (connection, user, data_version, CurrentState) of the daemon, see
+# currentState()
+stateCache = None
+
+def currentState(con):
+    """
+    Return the CurrentState for today. The daemon keeps it in memory between
+    commands as long as no other connection modified the database.
+    """
+    global stateCache
+    if not serving:
+        return CurrentState(con)
 
+    dataVersion = con.execute("PRAGMA data_version").fetchone()[0]
+    if (stateCache is None or stateCache[0] is not con or
+            stateCache[1] != con.user or stateCache[2] != dataVersion or
+            stateCache[3].day != date.today()):
+        stateCache = (con, con.user, dataVersion, CurrentState(con))
+    return stateCache[3]
+
+
+@retryLocked
 def revertLeave(con, date):
-    con.execute("UPDATE times SET type = '{}' WHERE date(ts) = date('{}')"
-    "AND type = '{}'".format(ACT_BREAK, date, ACT_LEAVE))
+    con.execute("UPDATE times SET type = ? WHERE user = ? AND type = ? "
+                "AND ts >= ? AND ts < ?",
+                (ACT_BREAK, con.user, ACT_LEAVE) + dayRange(date))
+    invalidateMonthSummary(con, date)
+    updateLedger(con, [date])
+    con.commit()
 
 def startTracking(con):
     """
     Start your day: Records your arrival time in the morning.
     """
     isResume = False
+    state = currentState(con)
 
     # Make sure you're not already at work.
-    lastType = getLastType(con, date.today())
+    lastType = state.lastTypeToday()
     if lastType is not None and lastType != ACT_LEAVE:
         error(randomMessage(MSG_ERR_HAVE_NOT_LEFT), None)
 
     if lastType == ACT_LEAVE:
-        should = input("You already left for today - do you really want to"
+        should = ask("You already left for today - do you really want to"
                 "return? [y/N] ")
         if should == 'y':
             # resumed work on same day after leave
             revertLeave(con, date.today())
+            state.revertLeave()
             isResume = True
         else:
-            raise ProgramAbortError('Aborted by user')
+            raise ProgramAbortError('Aborted by user', None)
 
     arrivalTime = datetime.now()
-    addEntry(con, ACT_RESUME if isResume else ACT_ARRIVE, arrivalTime)
+    type = ACT_RESUME if isResume else ACT_ARRIVE
+    addEntry(con, type, arrivalTime)
+    state.add(type, arrivalTime)
     message(randomMessage(MSG_SUCCESS_ARRIVAL, arrivalTime))
 
 
@@ -169,15 +546,15 @@ def suspendTracking(con):
 
     # Make sure you're currently working; can't suspend if you weren't even
     # working
-    lastType = getLastType(con)
-    lastTime = getLastTime(con)
-    if lastType not in [ACT_ARRIVE, ACT_RESUME]:
-        error(randomMessage(MSG_ERR_NOT_WORKING, lastType), None)
+    state = currentState(con)
+    if state.lastType not in [ACT_ARRIVE, ACT_RESUME]:
+        error(randomMessage(MSG_ERR_NOT_WORKING, state.lastType), None)
 
     breakTime = datetime.now()
     addEntry(con, ACT_BREAK, breakTime)
-    message(randomMessage(MSG_SUCCESS_BREAK, breakTime, lastTime))
-    dayStatistics(con)
+    message(randomMessage(MSG_SUCCESS_BREAK, breakTime, state.lastTime))
+    state.add(ACT_BREAK, breakTime)
+    dayStatistics(con, entries=state.entries)
 
 
 def resumeTracking(con):
@@ -188,15 +565,15 @@ def resumeTracking(con):
 
     # Make sure you're currently taking a break; can't resume if you were not
     # taking a break
-    lastType = getLastType(con)
-    lastTime = getLastTime(con)
-    if lastType != ACT_BREAK:
-        error(randomMessage(MSG_ERR_NOT_BREAKING, lastType), None)
+    state = currentState(con)
+    if state.lastType != ACT_BREAK:
+        error(randomMessage(MSG_ERR_NOT_BREAKING, state.lastType), None)
 
     resumeTime = datetime.now()
     addEntry(con, ACT_RESUME, resumeTime)
-    message(randomMessage(MSG_SUCCESS_RESUME, resumeTime, lastTime))
-    dayStatistics(con)
+    message(randomMessage(MSG_SUCCESS_RESUME, resumeTime, state.lastTime))
+    state.add(ACT_RESUME, resumeTime)
+    dayStatistics(con, entries=state.entries)
 
 
 def endTracking(con):
@@ -205,14 +582,15 @@ def endTracking(con):
     """
     # Make sure you've actually been at work. Can't leave if you're not even
     # here!
-    lastType = getLastType(con)
-    if lastType not in [ACT_ARRIVE, ACT_RESUME]:
-        error(randomMessage(MSG_ERR_NOT_WORKING, lastType), None)
+    state = currentState(con)
+    if state.lastType not in [ACT_ARRIVE, ACT_RESUME]:
+        error(randomMessage(MSG_ERR_NOT_WORKING, state.lastType), None)
 
     leaveTime = datetime.now()
     addEntry(con, ACT_LEAVE, leaveTime)
     message(randomMessage(MSG_SUCCESS_LEAVE, leaveTime))
-    dayStatistics(con)
+    state.add(ACT_LEAVE, leaveTime)
+    dayStatistics(con, entries=state.entries)
 
 def addSpecialEntries(con, type, start, end):
     delta = (end - start).days
@@ -226,12 +604,15 @@ def addSpecialEntries(con, type, start, end):
         else:
             print("-- skipping {}".format(day))
 
-    should = input("Do you really want to add those {} days? [y/N] "
+    should = ask("Do you really want to add those {} days? [y/N] "
             .format(len(days)))
     if should == 'y':
         for d in days:
             print("adding {}".format(d))
-            addEntry(con, type, d)
+        added = addEntries(con, [(type, d) for d in days], conflict='ignore')
+        if added < len(days):
+            warning("{} of those days were already recorded".format(
+                len(days) - added))
 
 def addVacation(con, start, end):
     addSpecialEntries(con, ACT_VACATION, start, end)
@@ -242,42 +623,235 @@ def addFza(con, start, end):
 def addSick(con, start, end):
     addSpecialEntries(con, ACT_SICK, start, end)
 
-def getEntries(con, d):
-    # Get the arrival for the date
-    cur = con.execute("SELECT ts FROM times WHERE type = ? AND ts >= ? AND ts "
-                      "< ? ORDER BY ts ASC LIMIT 1",
-                      (ACT_ARRIVE, datetime.combine(d, time()),
-                       datetime.combine(d + timedelta(days=1), time())))
-    res = cur.fetchone()
-    if not res:
-        # without arrival we expect vacation/sick
-        cur = con.execute("SELECT type, ts FROM times WHERE type IN (?,?,?) "
-                        "AND ts >= ? AND ts < ? ORDER BY ts ASC LIMIT 1",
-                      (ACT_SICK, ACT_VACATION, ACT_FZA, datetime.combine(d, time()),
-                       datetime.combine(d + timedelta(days=1), time())))
-        res = cur.fetchone()
-        if not res:
-            # nothing on this day
-            return []
-        return [(res['type'], res['ts'])]
-
-    # normal day here
-    startTime = res['ts']
-
-    # Use the end of the day as endtime
-    endTime = datetime.combine(d + timedelta(days=1), time())
-
-    # Get all entries between the start time, and the end time (if applicable)
-    cur = con.execute("SELECT type, ts FROM times WHERE ts >= ? AND ts < "
-                      "? ORDER BY ts ASC", (startTime, endTime))
-    return cur
+@retryLocked
+def setSchedule(con, since, weekHours):
+    """
+    Set the weekly hours of con.user from since on, or with weekHours None
+    remove the schedule entry starting at since. Drops the month summaries
+    and ledger days from since on. Returns whether the schedule changed.
+    """
+    if weekHours is None:
+        cur = con.execute("DELETE FROM schedule WHERE user = ? AND since = ?",
+                          (con.user, since))
+    else:
+        cur = con.execute("INSERT OR REPLACE INTO schedule (user, since, "
+                          "week_hours) VALUES (?, ?, ?)",
+                          (con.user, since, weekHours))
+    changed = cur.rowcount > 0
+    con.execute("DELETE FROM month_summary WHERE user = ? AND month >= ?",
+                (con.user, date(since.year, since.month, 1)))
+    con.execute("DELETE FROM ledger WHERE user = ? AND day >= ?",
+                (con.user, since))
+    con.commit()
+
+    global expectedCache
+    expectedCache = None
+    return changed
+
+def editSchedule(con, since=None, hours=None, remove=False):
+    """
+    Print the weekly hours of con.user, after setting them to hours from since
+    on or removing the change at since.
+    """
+    if since is not None:
+        since = cleanedDate(since)
+        if remove:
+            if not setSchedule(con, since, None):
+                warning("No schedule change on {:%d.%m.%Y}".format(since))
+        elif hours is None:
+            error("Weekly hours from {:%d.%m.%Y} on missing".format(since),
+                  None)
+        elif not 0 <= hours <= 7 * 24:
+            error("Not a number of weekly hours: {:g}".format(hours), None)
+        else:
+            setSchedule(con, since, hours)
+
+    schedule = loadSchedule(con, con.user)
+    if not schedule or schedule[0][0] > THE_START:
+        schedule.insert(0, (THE_START, WEEK_HOURS))
+    message("Weekly hours:")
+    for since, weekHours in schedule:
+        message("  since {:%d.%m.%Y}   {:>5g} h".format(since, weekHours))
+
+def emptyDays(firstDay, lastDay):
+    days = {}
+    curDay = firstDay
+    while curDay <= lastDay:
+        days[curDay] = []
+        curDay += timedelta(days=1)
+    return days
+
+def loadEntries(con, firstDay, lastDay):
+    """
+    Fetch all entries of con.user from firstDay to lastDay (both inclusive)
+    with a single query and split them into per-day groups. Returns a dict
+    mapping every date of the range to the list of its (type, ts) tuples in
+    chronological order.
+    """
+    days = emptyDays(firstDay, lastDay)
+    cur = con.execute("SELECT type, ts FROM times WHERE user = ? AND ts >= ? "
+                      "AND ts < ? ORDER BY ts ASC",
+                      (con.user, dayRange(firstDay)[0], dayRange(lastDay)[1]))
+    for type, ts in cur:
+        days[ts.date()].append((type, ts))
+    return days
+
+def listUsers(con):
+    return [row[0] for row in
+            con.execute("SELECT DISTINCT user FROM times ORDER BY user")]
+
+def loadEntriesByUser(con, firstDay, lastDay, users):
+    """
+    Like loadEntries() for several users at once, still with a single query.
+    Returns a dict mapping each of users to its loadEntries() dict.
+    """
+    byUser = {user: emptyDays(firstDay, lastDay) for user in users}
+    cur = con.execute("SELECT user, type, ts FROM times WHERE user IN ({}) "
+                      "AND ts >= ? AND ts < ? ORDER BY user, ts ASC"
+                      .format(", ".join("?" * len(byUser))),
+                      tuple(byUser) + (dayRange(firstDay)[0],
+                                       dayRange(lastDay)[1]))
+    for user, type, ts in cur:
+        byUser[user][ts.date()].append((type, ts))
+    return byUser
+
+def dayEntries(rows):
+    """
+    Reduce the rows of a single day to what the work time computation needs:
+    everything from the first arrival on or, without an arrival, the first
+    sick/vacation/fza entry.
+    """
+    for i, (type, ts) in enumerate(rows):
+        if type == ACT_ARRIVE:
+            return rows[i:]
+
+    # without arrival we expect vacation/sick
+    for type, ts in rows:
+        if type in [ACT_SICK, ACT_VACATION, ACT_FZA]:
+            return [(type, ts)]
+
+    # nothing on this day
+    return []
+
+def readImportRecords(f, format):
+    """
+    Yield (lineno, type, ts) tuples from a CSV or JSONL file object, ts still
+    unparsed. Lines that cannot be read are yielded with type None and the
+    reason in place of ts.
+    """
+    if format == 'csv':
+        import csv
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row == ['type', 'ts']:
+                continue
+            if len(row) != 2:
+                yield (reader.line_num, None,
+                       "expected 2 columns, got {}".format(len(row)))
+            else:
+                yield reader.line_num, row[0].strip(), row[1].strip()
+    else:
+        import json
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                yield lineno, record['type'], record['ts']
+            except (ValueError, KeyError, TypeError) as e:
+                yield lineno, None, "invalid record: {}".format(e)
+
+def importEntries(con, file, format=None, conflict='ignore', chunk_size=1000):
+    """
+    Bulk load (type, ts) records from a CSV or JSONL file ('-' for stdin).
+    The file is streamed and written in transactions of chunk_size entries;
+    invalid records are reported and skipped.
+    """
+    if format is None:
+        format = 'jsonl' if file.endswith(('.jsonl', '.json')) else 'csv'
+
+    if file == '-':
+        f = sys.stdin
+    else:
+        try:
+            f = open(file, newline='')
+        except OSError as e:
+            error("Cannot open {}".format(file), e)
+
+    imported = 0
+    rejected = 0
+    total = 0
+    chunk = []
+    try:
+        for lineno, type, ts in readImportRecords(f, format):
+            total += 1
+            reason = None
+            if type is None:
+                reason = ts
+            elif type not in ACT_ALL:
+                reason = "unknown type {!r}".format(type)
+            else:
+                try:
+                    ts = datetime.fromisoformat(ts)
+                    if ts.tzinfo is not None:
+                        reason = "timestamps with time zone are not supported"
+                except (ValueError, TypeError):
+                    reason = "invalid timestamp {!r}".format(ts)
+
+            if reason is not None:
+                warning("{}:{}: {}".format(file, lineno, reason))
+                rejected += 1
+                continue
+
+            chunk.append((type, ts))
+            if len(chunk) >= chunk_size:
+                imported += addEntries(con, chunk, conflict)
+                chunk = []
+
+        if chunk:
+            imported += addEntries(con, chunk, conflict)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    message("Imported {} of {} records, {} rejected, {} already present"
+            .format(imported, total, rejected, total - rejected - imported))
+
+def lastDayOfMonth(year, month):
+    if month == 12:
+        return date(year, 12, 31)
+    return date(year, month + 1, 1) - timedelta(days=1)
 
 def timeAsHourMinute(time):
     seconds = time.total_seconds() if time.total_seconds() > 0 else -time.total_seconds()
     return  ( int(seconds // (60 * 60)), int((seconds % 3600) // 60) )
 
 
+# The report classes keep points in time as integer microseconds since
+# EPOCH (naive local time) and durations as integer microseconds. Sums over
+# thousands of days are plain int additions then, and no precision is lost
+# against the datetime based computation.
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+MICROSECOND = timedelta(microseconds=1)
+MINUTE_US = 60 * 1000000
+DAY_US = 24 * 60 * MINUTE_US
+
+def toMicros(ts):
+    return (ts - EPOCH) // MICROSECOND
+
+def fromMicros(us):
+    return EPOCH + timedelta(microseconds=us)
+
+
+# States of the day state machine, see replayDay(). A day starts OFF, the
+# LEFT states are reached by a leave, the PAUSED ones have a break open.
+DAY_OFF, DAY_WORKING, DAY_PAUSED, DAY_LEFT, DAY_LEFT_PAUSED, DAY_SPECIAL = range(6)
+
 class WorkDay:
+    __slots__ = ('startUs', 'endUs', 'pauses', 'type', 'finished', 'anomalies',
+                 'state', 'openPauseUs')
+
     class Type(Enum):
         Normal = auto()
         Sick = auto()
@@ -285,54 +859,117 @@ class WorkDay:
         FZA = auto()
 
     class Pause:
+        __slots__ = ('startUs', 'endUs')
+
         def __init__(self):
-            self.start = None
-            self.end = None
+            self.startUs = None
+            self.endUs = None
+
+        @property
+        def start(self):
+            return fromMicros(self.startUs)
+
+        @start.setter
+        def start(self, ts):
+            self.startUs = toMicros(ts)
+
+        @property
+        def end(self):
+            return fromMicros(self.endUs)
+
+        @end.setter
+        def end(self, ts):
+            self.endUs = toMicros(ts)
+
+        def durationUs(self):
+            return self.endUs - self.startUs
 
         def duration(self):
-            return self.end - self.start
+            return timedelta(microseconds=self.durationUs())
 
         def valid(self):
-            return self.start and self.end
+            return self.startUs is not None and self.endUs is not None
 
     def __init__(self, day):
-        self.start = datetime(day.year, day.month, day.day)
-        self.end = self.start
+        self.startUs = (day.toordinal() - EPOCH_ORDINAL) * DAY_US
+        self.endUs = self.startUs
         self.pauses = []
         self.type = WorkDay.Type.Normal
         self.finished = False
+        self.anomalies = ()
+        # where replayDay() left the day, and the start of a break still open
+        self.state = DAY_OFF
+        self.openPauseUs = None
+
+    @property
+    def start(self):
+        return fromMicros(self.startUs)
+
+    @start.setter
+    def start(self, ts):
+        self.startUs = toMicros(ts)
+
+    @property
+    def end(self):
+        return fromMicros(self.endUs)
+
+    @end.setter
+    def end(self, ts):
+        self.endUs = toMicros(ts)
 
     def day(self):
-        return date(self.start.year, self.start.month, self.start.day)
+        return date.fromordinal(EPOCH_ORDINAL + self.startUs // DAY_US)
+
+    def addAnomaly(self, ts, description):
+        if not self.anomalies:
+            self.anomalies = []
+        self.anomalies.append((ts, description))
+
+    def anomalyString(self, skipMissingLeave=False):
+        return ", ".join(description if ts is None else
+                         "{} at {:%H:%M}".format(description, ts)
+                         for ts, description in self.anomalies
+                         if not (skipMissingLeave and description == "missing leave"))
 
     def is_unfinished_today(self):
-        return not self.finished and self.start.date() == date.today()
+        return (not self.finished and
+                EPOCH_ORDINAL + self.startUs // DAY_US == date.today().toordinal())
 
     def is_finished(self):
         return (self.type != self.type.Normal) or self.finished
 
-    def worktime(self):
-        if not self.start or not self.end:
-            return timedelta(seconds=0)
+    def currentlyHere(self):
+        return self.state == DAY_WORKING and self.day() == date.today()
 
-        pausetime = timedelta(seconds=0)
+    def worktimeUs(self):
+        pausetime = 0
         for p in self.pauses:
-            pausetime += p.duration()
-
-        endtime = datetime.now() if self.is_unfinished_today() else self.end
-        total = (endtime - self.start - pausetime)
+            pausetime += p.endUs - p.startUs
+
+        unfinishedToday = self.is_unfinished_today()
+        endtime = self.endUs
+        # a normal day today counts up to now once started
+        if (unfinishedToday and self.state != DAY_OFF and
+                self.type == WorkDay.Type.Normal):
+            endtime = toMicros(datetime.now())
+            # a break still running doesn't count as work time
+            if self.openPauseUs is not None:
+                endtime = min(endtime, self.openPauseUs)
+        total = endtime - self.startUs - pausetime
 
         # compensate overtime
         if self.type == WorkDay.Type.FZA:
-            total *= 0
+            total = 0
 
         # don't count incomplete times if it's not today - calculations would be
         # wrong
-        if not self.is_finished() and not self.is_unfinished_today():
-            total *= 0
+        if not self.is_finished() and not unfinishedToday:
+            total = 0
+
+        return total - total % MINUTE_US
 
-        floored = total - (total % timedelta(minutes=1))
-        return floored
+    def worktime(self):
+        return timedelta(microseconds=self.worktimeUs())
 
     def to_string(self, as_hours=False):
         h, m = timeAsHourMinute(self.worktime())
@@ -348,8 +985,12 @@ class WorkDay:
             return "{}   {:2d}:{:02d}   {}".format(self.day().strftime('%a %Y-%m-%d'),
                 h, m, pauseString)
         else:
+            # monthly reporting as decimal hours we round as expected
+            from decimal import Decimal, ROUND_HALF_UP
+            hours = (Decimal(self.worktime().total_seconds()) / 3600).quantize(
+                    Decimal('0.1'), rounding=ROUND_HALF_UP)
             return "{}   {:5}   {}".format(self.day().strftime('%a %Y-%m-%d'),
-                    round(Decimal(self.worktime().total_seconds()) / 3600, 1) , pauseString)
+                    hours, pauseString)
 
 
     def __str__(self):
@@ -366,48 +1007,73 @@ class WorkDay:
             h, m, pauseString)
 
 class WorkMonth:
+    __slots__ = ('date', 'expectedUs', 'actualUs', 'expectedWorkdays',
+                 'workdays', 'worktimesUs')
+
     def __init__(self, date):
         self.date = date
-        self.expectedTime = None
-        self.actualTime = None
+        self.expectedUs = None
+        self.actualUs = None
         self.expectedWorkdays = None
         self.workdays = []
+        # worktime per day, also available for months loaded from the
+        # month_summary table which don't carry the WorkDay objects
+        self.worktimesUs = array('q')
+
+    @property
+    def expectedTime(self):
+        return timedelta(microseconds=self.expectedUs)
+
+    @expectedTime.setter
+    def expectedTime(self, td):
+        self.expectedUs = td // MICROSECOND
+
+    @property
+    def actualTime(self):
+        return timedelta(microseconds=self.actualUs)
+
+    @actualTime.setter
+    def actualTime(self, td):
+        self.actualUs = td // MICROSECOND
 
     def __str__(self):
         dH, dM = timeAsHourMinute(self.delta())
         return "{} ({:2d} days): {:>6}{:3d} h {:02d} min".format(
                 self.date.strftime("%Y-%m"),
-                len(self.workdays),
+                self.numDays(),
                 "+" if self.delta().total_seconds() > 0 else "-",
                 abs(dH), dM)
 
     def delta(self):
-        return self.actualTime - self.expectedTime
+        return timedelta(microseconds=self.actualUs - self.expectedUs)
 
     def deltaString(self):
         dH, dM = timeAsHourMinute(self.delta())
         return "{} {:>2d} h {:02d} min".format("+" if self.delta().total_seconds() > 0
                 else "-", dH, dM)
 
+    def numDays(self):
+        return len(self.worktimesUs)
+
     def addDay(self, day):
         self.workdays.append(day)
+        self.worktimesUs.append(day.worktimeUs())
 
 class WorkYear:
+    __slots__ = ('months', 'year')
+
     def __init__(self, year):
         self.months = []
         self.year = year
 
-    def year(self):
-        return self.year
-
     def addMonth(self, month):
         self.months.append(month)
 
     def totalExpected(self):
-        return reduce(lambda x,y: x + y.expectedTime, self.months, timedelta(seconds=0))
+        return timedelta(microseconds=sum(m.expectedUs for m in self.months))
 
     def totalActual(self):
-        return reduce(lambda x,y: x + y.actualTime, self.months, timedelta(seconds=0))
+        return timedelta(microseconds=sum(m.actualUs for m in self.months))
 
     def firstMonth(self):
         return self.months[0].date.month
@@ -419,19 +1085,127 @@ class WorkYear:
         return self.totalActual() - self.totalExpected()
 
     def __str__(self):
-        dH, dM = timeAsHourMinute(self.delta())
-        return "{} ({:3d} days): {:>8}{:3d} h {:02d} min".format(self.year,
-                reduce(lambda x,y: x + len(y.workdays), self.months, 0),
-                "+" if self.delta().total_seconds() > 0 else "-",
-                abs(dH), dM)
-
-def getWorkTimeForDay(con, d=date.today()):
-    summaryTime = timedelta(0)
-    arrival = None
+        return yearString(self.year, sum(m.numDays() for m in self.months),
+                          self.delta())
+
+def yearString(year, days, delta):
+    dH, dM = timeAsHourMinute(delta)
+    return "{} ({:3d} days): {:>8}{:3d} h {:02d} min".format(year, days,
+            "+" if delta.total_seconds() > 0 else "-", abs(dH), dM)
+
+# what a transition does to the WorkDay
+DO_NOTHING, DO_START, DO_PAUSE, DO_RESUME, DO_END, DO_SPECIAL = range(6)
+
+SPECIAL_TYPES = (ACT_SICK, ACT_VACATION, ACT_FZA)
+
+# (state, type) -> (next state, action, anomaly or None). Anomalous
+# transitions still do what the day computation always did with such entries
+# (e.g. the last arrival wins), except that a second break or a resume
+# without break are ignored instead of aborting the report.
+DAY_TRANSITIONS = {
+    (DAY_OFF, ACT_ARRIVE):          (DAY_WORKING, DO_START, None),
+    (DAY_OFF, ACT_BREAK):           (DAY_OFF, DO_NOTHING, "break before arrival"),
+    (DAY_OFF, ACT_RESUME):          (DAY_OFF, DO_NOTHING, "resume before arrival"),
+    (DAY_OFF, ACT_LEAVE):           (DAY_OFF, DO_NOTHING, "leave before arrival"),
+
+    (DAY_WORKING, ACT_ARRIVE):      (DAY_WORKING, DO_START, "duplicate arrive"),
+    (DAY_WORKING, ACT_BREAK):       (DAY_PAUSED, DO_PAUSE, None),
+    (DAY_WORKING, ACT_RESUME):      (DAY_WORKING, DO_NOTHING, "resume without break"),
+    (DAY_WORKING, ACT_LEAVE):       (DAY_LEFT, DO_END, None),
+
+    (DAY_PAUSED, ACT_ARRIVE):       (DAY_PAUSED, DO_START, "arrive during break"),
+    (DAY_PAUSED, ACT_BREAK):        (DAY_PAUSED, DO_NOTHING, "break during break"),
+    (DAY_PAUSED, ACT_RESUME):       (DAY_WORKING, DO_RESUME, None),
+    (DAY_PAUSED, ACT_LEAVE):        (DAY_LEFT_PAUSED, DO_END, "leave during break"),
+
+    (DAY_LEFT, ACT_ARRIVE):         (DAY_LEFT, DO_START, "arrive after leave"),
+    (DAY_LEFT, ACT_BREAK):          (DAY_LEFT_PAUSED, DO_PAUSE, "break after leave"),
+    (DAY_LEFT, ACT_RESUME):         (DAY_LEFT, DO_NOTHING, "resume without break"),
+    (DAY_LEFT, ACT_LEAVE):          (DAY_LEFT, DO_END, "duplicate leave"),
+
+    (DAY_LEFT_PAUSED, ACT_ARRIVE):  (DAY_LEFT_PAUSED, DO_START, "arrive after leave"),
+    (DAY_LEFT_PAUSED, ACT_BREAK):   (DAY_LEFT_PAUSED, DO_NOTHING, "break during break"),
+    (DAY_LEFT_PAUSED, ACT_RESUME):  (DAY_LEFT, DO_RESUME, "resume after leave"),
+    (DAY_LEFT_PAUSED, ACT_LEAVE):   (DAY_LEFT_PAUSED, DO_END, "duplicate leave"),
+}
+DAY_TRANSITIONS.update({(DAY_OFF, special): (DAY_SPECIAL, DO_SPECIAL, None)
+                        for special in SPECIAL_TYPES})
+DAY_TRANSITIONS.update({(state, special): (DAY_SPECIAL, DO_SPECIAL,
+                                           special + " after arrival")
+                        for special in SPECIAL_TYPES
+                        for state in (DAY_WORKING, DAY_PAUSED, DAY_LEFT,
+                                      DAY_LEFT_PAUSED)})
+DAY_TRANSITIONS.update({(DAY_SPECIAL, type): (DAY_SPECIAL, DO_NOTHING,
+                                              type + " on a special day")
+                        for type in ACT_ALL})
+
+# event number per type, unknown types are event DAY_NUM_EVENTS - 1
+DAY_EVENTS = {type: i for i, type in enumerate(ACT_ALL)}
+DAY_NUM_EVENTS = len(ACT_ALL) + 1
+
+def compileTransitions(table):
+    """
+    Flatten the transition table into a tuple indexed by
+    state * DAY_NUM_EVENTS + event.
+    """
+    compiled = []
+    for state in range(DAY_SPECIAL + 1):
+        for event in range(DAY_NUM_EVENTS):
+            if event < len(ACT_ALL):
+                compiled.append(table[(state, ACT_ALL[event])])
+            else:
+                compiled.append((state, DO_NOTHING, "unknown type"))
+    return tuple(compiled)
+
+DAY_TRANSITION_TABLE = compileTransitions(DAY_TRANSITIONS)
+
+def replayDay(d, rows, expected=None):
+    """
+    Compute the WorkDay of d from all its rows in one pass through the day
+    state machine. Instead of aborting on inconsistent entries the day
+    collects them as (ts, description) in its anomalies list, ts being None
+    for things missing at the end of the day. Sick and vacation days are
+    credited the daily hours of expected, an ExpectedHours, or DAY_HOURS.
+    """
     day = WorkDay(d)
+
+    # only the entries from the first arrival on count, or the first special
+    # entry of a day without arrival
+    entries = dayEntries(rows)
+    if len(entries) < len(rows):
+        if entries and entries[0][0] == ACT_ARRIVE:
+            for type, ts in rows[:len(rows) - len(entries)]:
+                day.addAnomaly(ts, "{} before arrival".format(type))
+        else:
+            kept = entries[0] if entries else None
+            for row in rows:
+                if row == kept:
+                    kept = None
+                    continue
+                day.addAnomaly(row[1], "{} {}".format(row[0],
+                               "on a special day" if entries else "without arrival"))
+
+    state = DAY_OFF
     pause = None
-    for type, ts in getEntries(con, d):
-        if type in [ACT_SICK, ACT_VACATION, ACT_FZA]:
+    for type, ts in entries:
+        state, action, anomaly = DAY_TRANSITION_TABLE[
+                state * DAY_NUM_EVENTS + DAY_EVENTS.get(type, DAY_NUM_EVENTS - 1)]
+        if anomaly is not None:
+            day.addAnomaly(ts, anomaly)
+
+        if action == DO_START:
+            day.start = ts
+        elif action == DO_PAUSE:
+            pause = WorkDay.Pause()
+            pause.start = ts
+        elif action == DO_RESUME:
+            pause.end = ts
+            day.pauses.append(pause)
+            pause = None
+        elif action == DO_END:
+            day.end = ts
+            day.finished = True
+        elif action == DO_SPECIAL:
             if type == ACT_SICK:
                 day.type = WorkDay.Type.Sick
             elif type == ACT_VACATION:
@@ -441,79 +1215,72 @@ def getWorkTimeForDay(con, d=date.today()):
 
             # random start point
             day.start = datetime.combine(ts.date(), time(hour=8, minute=0, second=0))
-            day.end = day.start + timedelta(hours=DAY_HOURS)
-
-            return day
-        elif type == ACT_ARRIVE:
-            day.start = ts
-        elif type == ACT_LEAVE:
-            day.end = ts
-            day.finished = True;
-        elif type == ACT_BREAK:
-            if pause:
-                error("Break while pause active at {}".format(ts), None)
-
-            pause = WorkDay.Pause()
-            pause.start = ts
-        elif type == ACT_RESUME:
-            if not pause:
-                error("Resume while no pause active at {}".format(ts), None)
-
-            pause.end = ts
-            day.pauses.append(pause)
-            pause = None
-        else:
-            error("Unhandled type for {}".format(type, ts), None)
-
-
-    if day.start and not day.end:
-        day.end = datetime.now()
+            if expected is None:
+                day.end = day.start + timedelta(hours=DAY_HOURS)
+            else:
+                day.end = day.start + timedelta(
+                        seconds=expected.dailySeconds(d))
+
+    day.state = state
+    if pause is not None:
+        day.openPauseUs = pause.startUs
+
+    today = d == date.today()
+    if state in (DAY_WORKING, DAY_PAUSED) and not today:
+        day.addAnomaly(None, "missing leave")
+    if state == DAY_PAUSED and not today:
+        day.addAnomaly(None, "break without resume")
 
     return day
 
+def getWorkTimeForDay(con, d=date.today(), entries=None):
+    if entries is None:
+        entries = loadEntries(con, d, d)[d]
+    return replayDay(d, entries, dayExpectedHours(con, entries))
 
-def getWorkTimeForDay_old(con, d=date.today()):
-    summaryTime = timedelta(0)
-    arrival = None
-    for type, ts in getEntries(con, d):
-        if not arrival:
-            if type in [ACT_SICK, ACT_VACATION]:
-                return (False, summaryTime + timedelta(hours=DAY_HOURS))
-
-            if type not in [ACT_ARRIVE, ACT_RESUME]:
-                error("Expected arrival while computing presence time, got {}"
-                      " at {}".format(type, ts), None)
-            arrival = ts
-        else:
-            if type not in [ACT_BREAK, ACT_LEAVE]:
-                error("Expected break/leave while computing presence time, got"
-                      " {} at {}".format(type, ts), None)
-            summaryTime += ts - arrival
-            arrival = None
-    if arrival:
-        # open end
-        summaryTime += datetime.now() - arrival
-
-    return (arrival is not None, summaryTime)
+def dayExpectedHours(con, rows):
+    """
+    expectedHours(con) for replaying rows, the entries of a day, or None if
+    that doesn't need it: only special days are credited the daily hours.
+    Spares the punch commands reading the schedule.
+    """
+    if any(type in SPECIAL_TYPES for type, ts in dayEntries(rows)):
+        return expectedHours(con)
+    return None
 
 
-def dayStatistics(con, offset=0):
+def dayStatistics(con, offset=0, entries=None, ctx=None):
+    """
+    Print the entries and work time of a day. entries may carry the rows of
+    that day if the caller already has them, e.g. from CurrentState.
+    """
     headerPrinted = False
     targetDay = date.today() + timedelta(days=offset)
-    for type, ts in getEntries(con, targetDay):
+    if entries is None:
+        if ctx is None:
+            ctx = ReportContext(con)
+        entries = ctx.rows(targetDay, targetDay)[targetDay]
+        workday = ctx.workday(targetDay)
+    else:
+        workday = replayDay(targetDay, entries,
+                            dayExpectedHours(con, entries))
+    for type, ts in dayEntries(entries):
         if not headerPrinted:
             message("Time tracking entries for {:%d.%m.%Y}:".format(targetDay))
             headerPrinted = True
         message("  {:<10} {:%d.%m.%Y %H:%M}".format(type, ts))
 
-    currentlyHere, totalTime = getWorkTimeForDay_old(con)
-    if currentlyHere:
+    if workday.currentlyHere():
         message("You are currently at work.")
-    message("You have worked {} h {} min".format(
-        int(totalTime.total_seconds() // (60 * 60)),
-        int((totalTime.total_seconds() % 3600) // 60)))
+    totalHours, totalMinutes = timeAsHourMinute(workday.worktime())
+    message("You have worked {} h {} min".format(totalHours, totalMinutes))
 
-def monthStats(con, month, year):
+def newWorkMonth(month, year, expected):
+    """
+    Create a WorkMonth with the expected time filled in from expected, an
+    ExpectedHours. Returns the month and the first and last day to account
+    for.
+    """
     today = date(year, month, 1)
     m = WorkMonth(today)
 
@@ -522,38 +1289,516 @@ def monthStats(con, month, year):
         error("Month {} before {}".format(m.date, THE_START), None)
 
     firstDay = date(m.date.year, m.date.month, 1)
-    lastDay = date(m.date.year, m.date.month, calendar.monthrange(m.date.year, m.date.month)[1])
+    lastDay = lastDayOfMonth(m.date.year, m.date.month)
 
     if (firstDay < THE_START):
         firstDay = THE_START
 
-    workingDays = holiday_calendar.get_working_days_delta(firstDay, lastDay,
-            include_start=True)
-    dailyHours = timedelta(hours=DAY_HOURS)
+    m.expectedWorkdays = holiday_calendar.get_working_days_delta(firstDay,
+            lastDay, include_start=True)
+    m.expectedUs = expected.seconds(firstDay, lastDay) * 1000000
+
+    return m, firstDay, lastDay
+
+def monthStats(con, month, year, entries=None, workdays=None, user=None):
+    """
+    Compute a month of user, con.user by default, with its WorkDay objects.
+    entries may carry the loadEntries() result for the month if the caller
+    already has it, workdays a dict of WorkDay objects already computed, see
+    ReportContext.
+    """
+    expected = expectedHours(con, user)
+    m, firstDay, lastDay = newWorkMonth(month, year, expected)
 
-    m.expectedTime = dailyHours * workingDays
-    m.expectedWorkdays = workingDays
+    workedUs = 0
 
-    workedHours = timedelta(seconds=0)
+    if entries is None:
+        entries = loadEntries(con, firstDay, lastDay)
 
     curDay = firstDay
     while curDay <= lastDay:
         # add an entry for every day - even non-workdays so we can print time
         # worked there too - they are not contained in expected(Time|Workdays)
-        workday = getWorkTimeForDay(con, curDay)
-        workedHours += workday.worktime()
+        workday = workdays.get(curDay) if workdays else None
+        if workday is None:
+            workday = replayDay(curDay, entries[curDay], expected)
         m.addDay(workday)
+        workedUs += m.worktimesUs[-1]
 
         curDay += timedelta(days=1)
 
-    m.actualTime = workedHours
+    m.actualUs = workedUs
+
+    return m
+
+def monthStatsAllUsers(con, month, year, users=None):
+    """
+    monthStats() for users, all users of the database by default, from a
+    single query. Returns a dict mapping user to WorkMonth.
+    """
+    if users is None:
+        users = listUsers(con)
+    m, firstDay, lastDay = newWorkMonth(month, year, expectedHours(con))
+    entries = loadEntriesByUser(con, firstDay, lastDay, users)
+    return {user: monthStats(con, month, year, entries[user], user=user)
+            for user in users}
+
+_numpyEngine = None
+
+def numpyEngine():
+    """
+    Return the numpyengine module if enabled by "[report] engine = numpy" in
+    the config and numpy is available, None otherwise.
+    """
+    global _numpyEngine
+    if cfg.get('report', 'engine', fallback='python') != 'numpy':
+        return None
+    if _numpyEngine is None:
+        try:
+            import numpyengine
+            _numpyEngine = numpyengine
+        except ImportError as e:
+            warning("numpy engine not available, using python ({})".format(e))
+            _numpyEngine = False
+    return _numpyEngine or None
+
+def numpyMonthStats(engine, con, month, year):
+    """
+    Month aggregates computed by the numpy engine, without WorkDay objects.
+    Returns None if the engine can't handle the month's entries.
+    """
+    expected = expectedHours(con)
+    m, firstDay, lastDay = newWorkMonth(month, year, expected)
+
+    # event type codes as numpyengine expects them: index into ACT_ALL
+    cases = " ".join("WHEN ? THEN {}".format(i) for i in range(len(ACT_ALL)))
+    cur = con.execute("SELECT CASE type {} ELSE -1 END, CAST(ts AS TEXT) "
+                      "FROM times WHERE user = ? AND ts >= ? AND ts < ? "
+                      "ORDER BY ts ASC".format(cases),
+                      ACT_ALL + (con.user, dayRange(firstDay)[0],
+                                 dayRange(lastDay)[1]))
+    rows = cur.fetchall()
+
+    worktimes = engine.dayWorktimes(
+            engine.parseTimestamps([row[1] for row in rows]),
+            [row[0] for row in rows],
+            firstDay.toordinal() - EPOCH_ORDINAL,
+            (lastDay - firstDay).days + 1,
+            toMicros(datetime.now()),
+            [expected.dailySeconds(d) * 1000000
+             for d in emptyDays(firstDay, lastDay)])
+    if worktimes is None:
+        return None
+
+    m.worktimesUs = array('q', worktimes.tolist())
+    m.actualUs = int(worktimes.sum())
+    return m
+
+def summaryMonthStats(con, month, year):
+    """
+    Month aggregates for cachedMonthStats(), from the numpy engine if enabled,
+    from monthStats() otherwise.
+    """
+    engine = numpyEngine()
+    if engine is not None:
+        m = numpyMonthStats(engine, con, month, year)
+        if m is not None:
+            return m
+    return monthStats(con, month, year)
+
+def invalidateMonthSummary(con, d):
+    """
+    Drop the cached aggregates of con.user for the month containing d. Must
+    be called whenever entries of that month change.
+    """
+    con.execute("DELETE FROM month_summary WHERE user = ? AND month = ?",
+                (con.user, date(d.year, d.month, 1)))
 
+def loadMonthSummary(con, month, year):
+    row = con.execute("SELECT expected, actual, workdays, worktimes "
+                      "FROM month_summary WHERE user = ? AND month = ?",
+                      (con.user, date(year, month, 1))).fetchone()
+    if row is None:
+        return None
+    return monthFromSummary(row, month, year)
+
+def monthFromSummary(row, month, year):
+    # the table stores seconds, worktimes are floored to minutes anyway
+    m = WorkMonth(date(year, month, 1))
+    m.expectedUs = row['expected'] * 1000000
+    m.actualUs = row['actual'] * 1000000
+    m.expectedWorkdays = row['workdays']
+    m.worktimesUs = array('q', (int(s) * 1000000
+                                for s in row['worktimes'].split(',')))
     return m
 
-def printMonthStats(con, month, year, with_total=False, with_ytd=False, as_hours=False):
-    m = monthStats(con, month, year)
+def storeMonthSummary(con, m, user=None):
+    if user is None:
+        user = con.user
+    storeCache(con, lambda writer: writer.execute(
+            "INSERT OR REPLACE INTO month_summary (user, month, expected, "
+            "actual, workdays, worktimes) VALUES (?, ?, ?, ?, ?, ?)",
+            (user, m.date, m.expectedUs // 1000000, m.actualUs // 1000000,
+             m.expectedWorkdays,
+             ",".join(str(t // 1000000) for t in m.worktimesUs))))
+
+def cachedMonthStats(con, month, year):
+    """
+    Like monthStats(), but finished months are served from and stored to the
+    month_summary table. The returned month only carries the aggregates and
+    per-day worktimes, not the WorkDay objects.
+    """
+    lastDay = lastDayOfMonth(year, month)
+    if lastDay >= date.today():
+        # still running, entries may change any time
+        m = summaryMonthStats(con, month, year)
+    else:
+        m = loadMonthSummary(con, month, year)
+        if m is None:
+            m = summaryMonthStats(con, month, year)
+            storeMonthSummary(con, m)
+
+    # let go of the WorkDay objects, long reports would keep them all alive
+    m.workdays = []
+    return m
 
-    lastDay = date(m.date.year, m.date.month, calendar.monthrange(m.date.year, m.date.month)[1])
+def cachedMonthStatsAllUsers(con, month, year, users):
+    """
+    cachedMonthStats() for several users: the summaries are read with one
+    query and the months missing there computed from one entry query.
+    Returns a dict mapping user to WorkMonth.
+    """
+    closed = lastDayOfMonth(year, month) < date.today()
+    months = {}
+    if closed:
+        cur = con.execute("SELECT user, expected, actual, workdays, worktimes "
+                          "FROM month_summary WHERE month = ?",
+                          (date(year, month, 1),))
+        for row in cur:
+            if row['user'] in users:
+                months[row['user']] = monthFromSummary(row, month, year)
+
+    missing = [user for user in users if user not in months]
+    if missing:
+        for user, m in monthStatsAllUsers(con, month, year, missing).items():
+            m.workdays = []
+            if closed:
+                storeMonthSummary(con, m, user)
+            months[user] = m
+    return {user: months[user] for user in users}
+
+def loadSchedule(con, user):
+    return [(row['since'], row['week_hours']) for row in
+            con.execute("SELECT since, week_hours FROM schedule "
+                        "WHERE user = ? ORDER BY since ASC", (user,))]
+
+# (connection, data_version, {user: ExpectedHours}), see expectedHours()
+expectedCache = None
+
+def expectedHours(con, user=None):
+    """
+    The ExpectedHours of user, con.user by default. They are kept for the
+    connection; the daemon drops them when another connection modified the
+    database, setSchedule() whenever it changes the schedule.
+    """
+    global expectedCache
+    if user is None:
+        user = con.user
+
+    dataVersion = None
+    if serving:
+        dataVersion = con.execute("PRAGMA data_version").fetchone()[0]
+    if (expectedCache is None or expectedCache[0] is not con or
+            expectedCache[1] != dataVersion):
+        expectedCache = (con, dataVersion, {})
+    byUser = expectedCache[2]
+    if user not in byUser:
+        byUser[user] = ExpectedHours(holiday_calendar, THE_START,
+                                     loadSchedule(con, user), WEEK_HOURS)
+    return byUser[user]
+
+def dayActualSeconds(con, firstDay, lastDay, user=None):
+    """
+    Worktime in seconds of the days from firstDay to lastDay having entries.
+    Returns a dict mapping date to seconds, days without entries are missing.
+    """
+    expected = expectedHours(con, user)
+    return {d: replayDay(d, rows, expected).worktimeUs() // 1000000
+            for d, rows in iterDayRows(con, firstDay, lastDay, user)}
+
+def ledgerRows(con, user, firstDay, lastDay, cumExpected, cumActual):
+    """
+    Ledger rows of user from firstDay to lastDay, continuing the running sums
+    cumExpected and cumActual of the day before firstDay.
+    """
+    actual = dayActualSeconds(con, firstDay, lastDay, user)
+    rows = []
+    d = firstDay
+    for expected in expectedHours(con, user).daySeconds(firstDay, lastDay):
+        cumExpected += expected
+        cumActual += actual.get(d, 0)
+        rows.append((user, d, expected, actual.get(d, 0), cumExpected,
+                     cumActual))
+        d += timedelta(days=1)
+    return rows
+
+def extendLedger(con, user):
+    """
+    Append the days of user missing in the ledger up to yesterday; today can
+    still change and is never stored. If the rows can't be stored, they are
+    returned as a dict mapping date to (cum_expected, cum_actual), otherwise
+    the dict is empty.
+    """
+    yesterday = date.today() - timedelta(days=1)
+
+    def missingRows(con):
+        row = con.execute("SELECT day, cum_expected, cum_actual FROM ledger "
+                          "WHERE user = ? ORDER BY day DESC LIMIT 1",
+                          (user,)).fetchone()
+        if row is None:
+            return ledgerRows(con, user, THE_START, yesterday, 0, 0)
+        return ledgerRows(con, user, row['day'] + timedelta(days=1),
+                          yesterday, row['cum_expected'], row['cum_actual'])
+
+    # the rows are replayed on con without holding the write lock, they are
+    # only stored if no entries were written meanwhile
+    version = con.execute("PRAGMA data_version").fetchone()[0]
+    rows = missingRows(con)
+    if not rows:
+        return {}
+    def store(writer):
+        writer.execute("BEGIN IMMEDIATE")
+        if con.execute("PRAGMA data_version").fetchone()[0] != version:
+            return False
+        writer.executemany("INSERT OR REPLACE INTO ledger (user, day, "
+                           "expected, actual, cum_expected, cum_actual) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    if storeCache(con, store):
+        return {}
+    return {row[1]: row[4:] for row in rows}
+
+def updateLedger(con, days):
+    """
+    Recompute the ledger of con.user for days whose entries changed and shift
+    the running sums of all later days. Days not in the ledger yet are left to
+    extendLedger(). Part of the caller's transaction.
+    """
+    days = {cleanedDate(d) for d in days}
+    if not days:
+        return
+    first = min(days)
+    rows = con.execute("SELECT day, actual FROM ledger WHERE user = ? "
+                       "AND day >= ? ORDER BY day ASC",
+                       (con.user, first)).fetchall()
+    if not rows:
+        return
+
+    prev = con.execute("SELECT cum_actual FROM ledger WHERE user = ? "
+                       "AND day < ? ORDER BY day DESC LIMIT 1",
+                       (con.user, first)).fetchone()
+    cumActual = prev['cum_actual'] if prev else 0
+    actual = dayActualSeconds(con, first, max(days))
+    updates = []
+    for row in rows:
+        dayActual = actual.get(row['day'], 0) if row['day'] in days \
+                    else row['actual']
+        cumActual += dayActual
+        updates.append((dayActual, cumActual, con.user, row['day']))
+    con.executemany("UPDATE ledger SET actual = ?, cum_actual = ? "
+                    "WHERE user = ? AND day = ?", updates)
+
+def ledgerBalance(con, d, user, pending):
+    """
+    Running sums (expected, actual) in seconds of user from THE_START to d,
+    which has to be before today. pending holds rows extendLedger() couldn't
+    store.
+    """
+    if d < THE_START:
+        return (0, 0)
+    if d in pending:
+        return pending[d]
+    row = con.execute("SELECT cum_expected, cum_actual FROM ledger "
+                      "WHERE user = ? AND day = ?", (user, d)).fetchone()
+    return (row['cum_expected'], row['cum_actual'])
+
+class Balance:
+    """
+    Expected and actual time from first to last, taken from the ledger
+    instead of WorkMonth objects, see ReportContext.balance().
+    """
+    __slots__ = ('first', 'last', 'expectedUs', 'actualUs')
+
+    def __init__(self, first, last, expectedUs, actualUs):
+        self.first = first
+        self.last = last
+        self.expectedUs = expectedUs
+        self.actualUs = actualUs
+
+    def numDays(self):
+        return (self.last - self.first).days + 1
+
+    def totalExpected(self):
+        return timedelta(microseconds=self.expectedUs)
+
+    def totalActual(self):
+        return timedelta(microseconds=self.actualUs)
+
+    def delta(self):
+        return self.totalActual() - self.totalExpected()
+
+class YearBalance(Balance):
+    """
+    Balance of a year, printed like a WorkYear by total.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return yearString(self.first.year, self.numDays(), self.delta())
+
+class ReportContext:
+    """
+    Memoizes the days, months and years computed during a single invocation,
+    so a combined report like month --with-ytd --with-total computes every
+    month only once, and day, week and month views share their WorkDays.
+    """
+    def __init__(self, con):
+        self.con = con
+        self.dayRows = {}
+        self.workdays = {}
+        self.details = {}
+        self.summaries = {}
+        self.years = {}
+        self.users = None
+        self.userSummaries = {}
+        self.userYears = {}
+        self.ledgers = {}
+
+    def rows(self, firstDay, lastDay):
+        """
+        Rows per day from firstDay to lastDay, see loadEntries(). Only days
+        not loaded before are queried, with a single query.
+        """
+        missing = [d for d in emptyDays(firstDay, lastDay)
+                   if d not in self.dayRows]
+        if missing:
+            self.dayRows.update(loadEntries(self.con, missing[0], missing[-1]))
+        return {d: self.dayRows[d] for d in emptyDays(firstDay, lastDay)}
+
+    def workday(self, d):
+        if d not in self.workdays:
+            self.workdays[d] = replayDay(d, self.rows(d, d)[d],
+                                         expectedHours(self.con))
+        return self.workdays[d]
+
+    def month(self, month, year):
+        """
+        Month with its WorkDay objects, see monthStats().
+        """
+        key = (year, month)
+        if key not in self.details:
+            m = monthStats(self.con, month, year,
+                           self.rows(date(year, month, 1),
+                                     lastDayOfMonth(year, month)),
+                           self.workdays)
+            for workday in m.workdays:
+                self.workdays[workday.day()] = workday
+            self.details[key] = m
+        return self.details[key]
+
+    def summary(self, month, year):
+        """
+        Month aggregates, see cachedMonthStats().
+        """
+        key = (year, month)
+        if key in self.details:
+            return self.details[key]
+        if key not in self.summaries:
+            self.summaries[key] = cachedMonthStats(self.con, month, year)
+        return self.summaries[key]
+
+    def year(self, year, firstMonth, lastMonth):
+        key = (year, firstMonth, lastMonth)
+        if key not in self.years:
+            workYear = WorkYear(year)
+            for month in range(firstMonth, lastMonth + 1):
+                workYear.addMonth(self.summary(month, year))
+            self.years[key] = workYear
+        return self.years[key]
+
+    def cumulative(self, d, user):
+        """
+        Running sums of user up to d, see ledgerBalance(). The ledger is
+        extended on first use.
+        """
+        if user not in self.ledgers:
+            self.ledgers[user] = extendLedger(self.con, user)
+        return ledgerBalance(self.con, d, user, self.ledgers[user])
+
+    def balance(self, first, last, user, cls=Balance):
+        """
+        Balance of user from first to last, both on or after THE_START: closed
+        days from two ledger lookups, today and later from their entries.
+        """
+        today = date.today()
+
+        expected = actual = 0
+        closed = min(last, today - timedelta(days=1))
+        if closed >= first:
+            endExpected, endActual = self.cumulative(closed, user)
+            startExpected, startActual = self.cumulative(
+                    first - timedelta(days=1), user)
+            expected = endExpected - startExpected
+            actual = endActual - startActual
+
+        start = max(first, today)
+        if start <= last:
+            actual += sum(dayActualSeconds(self.con, start, last,
+                                           user).values())
+            expected += expectedHours(self.con, user).seconds(start, last)
+
+        return cls(first, last, expected * 1000000, actual * 1000000)
+
+    def yearBalance(self, year, toMonth, user):
+        """
+        YearBalance of user over the months yearlyStats() would cover.
+        """
+        firstMonth, lastMonth = yearMonths(year, toMonth, 1)
+        return self.balance(max(date(year, firstMonth, 1), THE_START),
+                            lastDayOfMonth(year, lastMonth), user, YearBalance)
+
+    def allUsers(self):
+        if self.users is None:
+            self.users = listUsers(self.con)
+        return self.users
+
+    def summaryAllUsers(self, month, year):
+        """
+        Month aggregates of all users, see cachedMonthStatsAllUsers().
+        """
+        key = (year, month)
+        if key not in self.userSummaries:
+            self.userSummaries[key] = cachedMonthStatsAllUsers(
+                    self.con, month, year, self.allUsers())
+        return self.userSummaries[key]
+
+    def yearAllUsers(self, year, firstMonth, lastMonth):
+        key = (year, firstMonth, lastMonth)
+        if key not in self.userYears:
+            workYears = {user: WorkYear(year) for user in self.allUsers()}
+            for month in range(firstMonth, lastMonth + 1):
+                for user, m in self.summaryAllUsers(month, year).items():
+                    workYears[user].addMonth(m)
+            self.userYears[key] = workYears
+        return self.userYears[key]
+
+def printMonthStats(con, month, year, with_total=False, with_ytd=False,
+                    as_hours=False, ctx=None):
+    if ctx is None:
+        ctx = ReportContext(con)
+    m = ctx.month(month, year)
+
+    lastDay = lastDayOfMonth(m.date.year, m.date.month)
 
     print("Work time for {}:\n".format(m.date.strftime("%B '%y")))
     print("     Day         Hours   Pauses / Comment")
@@ -584,6 +1829,13 @@ def printMonthStats(con, month, year, with_total=False, with_ytd=False, as_hours
                     comment += " "
                 comment += holiday_calendar.get_holiday_label(today)
 
+            # missing leaves are UNFINISHED already
+            anomalies = workday.anomalyString(skipMissingLeave=True)
+            if anomalies:
+                if len(comment) > 0:
+                    comment += " "
+                comment += "/!\\ {} /!\\".format(anomalies)
+
             print("{} {}".format(workday.to_string(as_hours=as_hours), comment))
 
     expectedHours, expectedMinutes = timeAsHourMinute(m.expectedTime)
@@ -600,39 +1852,72 @@ def printMonthStats(con, month, year, with_total=False, with_ytd=False, as_hours
     if with_ytd:
         print()
         print()
-        printYearlyStats(con, year, month)
+        printYearlyStats(con, year, month, ctx=ctx)
 
     if with_total:
         print()
         print()
-        printTotalStats(con, year, month)
+        printTotalStats(con, year, month, ctx=ctx)
 
-def yearlyStats(con, year, toMonth=12, fromMonth=1):
+def yearMonths(year, toMonth, fromMonth):
     if (toMonth < fromMonth):
         toMonth = fromMonth
 
     y = date(year, toMonth, 1)
     firstMonth = THE_START.month if (y.year <= THE_START.year) else fromMonth
+    return firstMonth, y.month
 
-    workYear = WorkYear(year)
+def yearlyStats(con, year, toMonth=12, fromMonth=1, ctx=None):
+    if ctx is None:
+        ctx = ReportContext(con)
+    return ctx.year(year, *yearMonths(year, toMonth, fromMonth))
 
-    for month in range(firstMonth, y.month + 1):
-        m = monthStats(con, month, y.year)
-        workYear.addMonth(m)
+def yearlyStatsAllUsers(con, year, toMonth=12, fromMonth=1, ctx=None):
+    """
+    yearlyStats() for all users in one pass. Returns a dict mapping user to
+    WorkYear.
+    """
+    if ctx is None:
+        ctx = ReportContext(con)
+    return ctx.yearAllUsers(year, *yearMonths(year, toMonth, fromMonth))
 
-    return workYear
+def printUserHeader(user, first):
+    if not first:
+        print()
+        print()
+    print("User {}:\n".format(user if user else "(default)"))
+
+def printYearlyStats(con, year, toMonth=12, fromMonth=1, ctx=None,
+                     all_users=False):
+    if all_users:
+        workYears = yearlyStatsAllUsers(con, year, toMonth, fromMonth, ctx)
+        for i, (user, wy) in enumerate(workYears.items()):
+            printUserHeader(user, i == 0)
+            printWorkYear(wy, yearDaySeconds(con, wy, user))
+    else:
+        wy = yearlyStats(con, year, toMonth, fromMonth, ctx)
+        printWorkYear(wy, yearDaySeconds(con, wy))
 
-def printYearlyStats(con, year, toMonth=12, fromMonth=1):
-    wy = yearlyStats(con, year, toMonth, fromMonth)
+def yearDaySeconds(con, wy, user=None):
+    """
+    Seconds per working day of user's schedule at the end of wy, a WorkYear.
+    """
+    return expectedHours(con, user).dailySeconds(
+            lastDayOfMonth(wy.year, wy.lastMonth()))
 
+def printWorkYear(wy, daySeconds):
     print("Yearly summary for {} {:02d}-{:02d}:\n".format(wy.year,
         wy.firstMonth(), wy.lastMonth()))
 
     for m in wy.months:
         print("{}".format(m))
 
-    totalExpected = wy.totalExpected()
-    totalActual = wy.totalActual()
+    printBalance(wy.totalExpected(), wy.totalActual(), daySeconds)
+
+def printBalance(totalExpected, totalActual, daySeconds):
+    """
+    Print the totals, the difference also in working days of daySeconds.
+    """
     totalDiff = totalActual - totalExpected
 
     tEH, tEM = timeAsHourMinute(totalExpected)
@@ -642,20 +1927,66 @@ def printYearlyStats(con, year, toMonth=12, fromMonth=1):
     print("total actual:  {:>13d} h {:02d} min".format(tAH, tAM))
 
     tdH, tdM = timeAsHourMinute(totalDiff)
-    tdD = round(totalDiff.total_seconds() / (60 * 60 * DAY_HOURS), ndigits=2)
+    tdD = round(totalDiff.total_seconds() / daySeconds, ndigits=2)
     print("total diff:    {:>10}{:>3d} h {:02d} min (workdays: {})".format(
         ("+" if totalDiff.total_seconds() > 0 else "-"),  tdH, tdM, tdD))
 
-def printTotalStats(con, year, toMonth=12):
-    years = []
+def printTotalStats(con, year, toMonth=12, ctx=None, all_users=False):
+    """
+    Print the balance of every year up to year, answered from the ledger, see
+    ReportContext.yearBalance().
+    """
+    if ctx is None:
+        ctx = ReportContext(con)
+
+    users = ctx.allUsers() if all_users else [con.user]
+    for i, user in enumerate(users):
+        if all_users:
+            printUserHeader(user, i == 0)
+        printTotals([ctx.yearBalance(y, 12 if y < date.today().year
+                                        else toMonth, user)
+                     for y in range(THE_START.year, year + 1)],
+                    expectedHours(con, user).dailySeconds(
+                        lastDayOfMonth(year, toMonth)))
+
+def rangeStats(con, start, end, ctx=None, user=None):
+    """
+    Balance of user, con.user by default, from start to end, both inclusive,
+    at the cost of a few ledger lookups whatever the length of the range.
+    """
+    if user is None:
+        user = con.user
+    if ctx is None:
+        ctx = ReportContext(con)
+    start = cleanedDate(start)
+    end = cleanedDate(end)
+    if start > end:
+        error("Range start {} after its end {}".format(start, end), None)
+    if end < THE_START:
+        error("Range {} - {} before {}".format(start, end, THE_START), None)
+    return ctx.balance(max(start, THE_START), end, user)
+
+def printRangeStats(con, start, end, ctx=None, all_users=False):
+    if ctx is None:
+        ctx = ReportContext(con)
+
+    users = ctx.allUsers() if all_users else [con.user]
+    for i, user in enumerate(users):
+        if all_users:
+            printUserHeader(user, i == 0)
+        b = rangeStats(con, start, end, ctx, user)
+        print("Summary for {:%d.%m.%Y} - {:%d.%m.%Y} ({} days):\n".format(
+            b.first, b.last, b.numDays()))
+        printBalance(b.totalExpected(), b.totalActual(),
+                     expectedHours(con, user).dailySeconds(b.last))
+
+def printTotals(years, daySeconds):
     totalExpected = timedelta(seconds=0)
     totalActual = timedelta(seconds=0)
 
     print("Totals:\n")
 
-    for y in range(THE_START.year, year + 1):
-        month = 12 if y < date.today().year else toMonth
-        ys = yearlyStats(con, y, month)
+    for ys in years:
         totalExpected += ys.totalExpected()
         totalActual += ys.totalActual()
         print("{}".format(ys))
@@ -668,12 +1999,87 @@ def printTotalStats(con, year, toMonth=12):
     print("-" * 40)
 
     tdH, tdM = timeAsHourMinute(totalDiff)
-    tdD = round(totalDiff.total_seconds() / (60 * 60 * DAY_HOURS), ndigits=2)
+    tdD = round(totalDiff.total_seconds() / daySeconds, ndigits=2)
     print("total diff:    {:>10}{:>3d} h {:02d} min (workdays: {})".format(
         ("+" if totalDiff.total_seconds() > 0 else "-"),  tdH, tdM, tdD))
 
 
-def weekStatistics(con, offset=0):
+# what a report task prints, see runReportTask()
+REPORT_KINDS = {
+    'month':    printMonthStats,
+    'year':     printYearlyStats,
+}
+
+def runReportTask(task):
+    """
+    Run a (user, kind, args) report task on its own read-only connection.
+    Returns the printed report and the error message if it failed.
+    """
+    import contextlib
+    import io
+
+    user, kind, args = task
+    out = io.StringIO()
+    con = dbOpenReadOnly(user)
+    try:
+        with contextlib.redirect_stdout(out):
+            REPORT_KINDS[kind](con, *args)
+    except ProgramAbortError as e:
+        return out.getvalue(), str(e)
+    finally:
+        dbClose(con)
+    return out.getvalue(), None
+
+def printReports(con, month, year, all_users=False, per='user', jobs=None):
+    """
+    Print the month report of every user (all_users) or con.user, or with per set
+    to 'year' their yearly reports since THE_START up to year/month. The
+    reports are computed by a pool of jobs worker processes, one CPU each by
+    default, and printed in order of user and year.
+    """
+    users = listUsers(con) if all_users else [con.user]
+    if per == 'user':
+        tasks = [(user, 'month', (month, year)) for user in users]
+    else:
+        tasks = [(user, 'year', (y, 12 if y < year else month))
+                 for user in users for y in range(THE_START.year, year + 1)]
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(tasks))
+    if jobs <= 1:
+        results = map(runReportTask, tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        # workers started with "spawn" don't inherit the config
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=readConfig)
+        results = executor.map(runReportTask, tasks)
+
+    failed = False
+    lastUser = None
+    try:
+        for i, ((user, kind, args), (output, err)) in enumerate(zip(tasks,
+                                                                    results)):
+            if all_users and user != lastUser:
+                printUserHeader(user, i == 0)
+                lastUser = user
+            elif i > 0:
+                print()
+                print()
+            sys.stdout.write(output)
+            if err is not None:
+                print(err, file=sys.stderr)
+                failed = True
+    finally:
+        if jobs > 1:
+            executor.shutdown(cancel_futures=True)
+
+    if failed:
+        error("Not all reports could be created", None)
+
+def weekStatistics(con, offset=0, ctx=None):
+    if ctx is None:
+        ctx = ReportContext(con)
     today = date.today()
     startOfWeek = (today - timedelta(days=today.weekday()) +
                    timedelta(weeks=offset))
@@ -683,41 +2089,40 @@ def weekStatistics(con, offset=0):
         startOfWeek.isocalendar()[1]))
 
     current = startOfWeek
-    dailyHours = timedelta(hours=DAY_HOURS)
+    expected = expectedHours(con)
     weekTotal = timedelta(seconds=0)
     extraHours = timedelta(seconds=0)
+    expectation = timedelta(seconds=0)
     daysSoFar = 0
 
-    headerPrinted = False
     currentlyHere = False
 
+    # load the whole week at once, the days are then replayed one by one
+    ctx.rows(startOfWeek, endOfWeek - timedelta(days=1))
+
+    message("   date         hours         diff ")
+    message("  ----------   -----------   ------")
     while current < endOfWeek:
-        try:
-            currentlyHere, timeForDay = getWorkTimeForDay_old(con, current)
-            daysSoFar += 1
-            totalHours = int(timeForDay.total_seconds() // (60 * 60))
-            totalMinutes = int((timeForDay.total_seconds() % 3600) // 60)
-
-            timedeltaForDay = timeForDay - dailyHours
-            timedeltaHours = timedeltaForDay.total_seconds() / (60 * 60)
-
-            weekTotal += timeForDay
-            extraHours += timedeltaForDay
-
-            if not headerPrinted:
-                headerPrinted = True
-                message("   date         hours         diff ")
-                message("  ----------   -----------   ------")
-            message("  {:%d.%m.%Y}   {:>2d} h {:>02d} min    {: =+1.2f}"
-                    .format(current, totalHours, totalMinutes, timedeltaHours))
-        except ProgramAbortError as pae:
-            if current.weekday() < 5:
-                # For non-weekend days, print a message
-                if not headerPrinted:
-                    headerPrinted = True
-                    message("   date         hours         diff ")
-                    message("  ----------   -----------   ------")
-                message("  {:%d.%m.%Y}    -              -".format(current))
+        workday = ctx.workday(current)
+        currentlyHere = workday.currentlyHere()
+        daysSoFar += 1
+        timeForDay = workday.worktime()
+        totalHours, totalMinutes = timeAsHourMinute(timeForDay)
+
+        dailyHours = timedelta(seconds=expected.dailySeconds(current))
+        expectation += dailyHours
+        timedeltaForDay = timeForDay - dailyHours
+        timedeltaHours = timedeltaForDay.total_seconds() / (60 * 60)
+
+        weekTotal += timeForDay
+        extraHours += timedeltaForDay
+
+        anomalies = workday.anomalyString()
+        if anomalies:
+            anomalies = "   /!\\ {} /!\\".format(anomalies)
+        message("  {:%d.%m.%Y}   {:>2d} h {:>02d} min    {: =+1.2f}{}"
+                .format(current, totalHours, totalMinutes, timedeltaHours,
+                        anomalies))
 
         current += timedelta(days=1)
 
@@ -729,7 +2134,6 @@ def weekStatistics(con, offset=0):
     if daysSoFar < 5:
         # The week isn't over, compare your current state against the ideal
         # rate
-        expectation = dailyHours * daysSoFar
         expectationHours = int(expectation.total_seconds() // (60 * 60))
         expectationMinutes = int((expectation.total_seconds() % 3600) // 60)
         message("   Expected:   {:>2d} h {:>02d} min"
@@ -739,7 +2143,9 @@ def weekStatistics(con, offset=0):
                     weekTotalMinutes, weekExtraHours))
     if daysSoFar < 5 or (daysSoFar == 5 and currentlyHere):
         # Calculate avg. remaining work time per day
-        totalExpectation = timedelta(hours=WEEK_HOURS)
+        totalExpectation = sum((timedelta(seconds=expected.dailySeconds(
+                                    startOfWeek + timedelta(days=i)))
+                                for i in range(5)), timedelta(0))
         remaining = totalExpectation - weekTotal
         remainingHours = int(remaining.total_seconds() // (60 * 60))
         remainingMinutes = int((remaining.total_seconds() % 3600) // 60)
@@ -756,6 +2162,250 @@ def weekStatistics(con, offset=0):
             message("      Daily:   {:>2d} h {:>02d} min"
                     .format(remainingPerDayHours, remainingPerDayMinutes))
 
+def iterDayRows(con, firstDay=None, lastDay=None, user=None):
+    """
+    Yield (date, rows) for every day of user, con.user by default, having
+    entries, from a single query streamed in chronological order.
+    """
+    import itertools
+    sql = "SELECT type, ts FROM times WHERE user = ?"
+    params = [con.user if user is None else user]
+    if firstDay is not None:
+        sql += " AND ts >= ?"
+        params.append(dayRange(firstDay)[0])
+    if lastDay is not None:
+        sql += " AND ts < ?"
+        params.append(dayRange(lastDay)[1])
+    cur = con.execute(sql + " ORDER BY ts ASC", params)
+    for d, rows in itertools.groupby(cur, key=lambda row: row[1].date()):
+        yield d, [(type, ts) for type, ts in rows]
+
+def checkEntries(con, start=None, end=None):
+    """
+    Replay all days from start to end, the whole history by default, and list
+    every inconsistency found in their entries.
+    """
+    firstDay = cleanedDate(start)
+    lastDay = cleanedDate(end)
+
+    anomalies = 0
+    days = 0
+    for d, rows in iterDayRows(con, firstDay, lastDay):
+        workday = replayDay(d, rows)
+        if not workday.anomalies:
+            continue
+        days += 1
+        for ts, description in workday.anomalies:
+            anomalies += 1
+            message("{:%a %Y-%m-%d}  {:5}  {}".format(d,
+                    "" if ts is None else "{:%H:%M}".format(ts), description))
+
+    if anomalies:
+        error("{} inconsistencies on {} days".format(anomalies, days), None)
+    message("No inconsistencies found")
+
+class TodayCounter:
+    """
+    Today's worktime, advanced from the clock without touching the database.
+    Like WorkDay.worktime() the counter stands still during a break, and only
+    runs on a normal day after arriving.
+    """
+    STATUS = {
+        None:           "not started",
+        ACT_ARRIVE:     "working",
+        ACT_RESUME:     "working",
+        ACT_BREAK:      "on break",
+        ACT_LEAVE:      "done",
+        ACT_SICK:       "sick",
+        ACT_VACATION:   "vacation",
+        ACT_FZA:        "fza",
+    }
+
+    def __init__(self, con):
+        state = CurrentState(con)
+        self.day = state.day
+        self.status = self.STATUS.get(state.lastTypeToday(), "unknown")
+
+        entries = dayEntries(state.entries)
+        workday = getWorkTimeForDay(con, self.day, state.entries)
+        self.fixedUs = None
+        if not entries:
+            self.fixedUs = 0
+        elif (workday.type == WorkDay.Type.Normal and
+              workday.state != DAY_OFF and workday.is_unfinished_today()):
+            # worktime = now - start - pauses, or break start - ... on a break
+            self.offsetUs = -workday.startUs - sum(p.durationUs()
+                                                   for p in workday.pauses)
+            self.frozenUs = workday.openPauseUs
+        else:
+            self.fixedUs = workday.worktimeUs()
+
+    def worktimeUs(self, now):
+        if self.fixedUs is not None:
+            return self.fixedUs
+        total = (self.frozenUs or toMicros(now)) + self.offsetUs
+        return total - total % MINUTE_US
+
+    def line(self, now):
+        h, m = timeAsHourMinute(timedelta(microseconds=self.worktimeUs(now)))
+        return "{:d}:{:02d} {}".format(h, m, self.status)
+
+def dbChangeStamp():
+    """
+    Modification times of the database and its WAL file, changing whenever
+    some process writes to the database.
+    """
+    stamp = []
+    for path in (cfg['db']['file'], cfg['db']['file'] + "-wal"):
+        try:
+            stamp.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+async def watchDbChanges(changed, pollInterval):
+    import asyncio
+    stamp = dbChangeStamp()
+    while True:
+        await asyncio.sleep(pollInterval)
+        current = dbChangeStamp()
+        if current != stamp:
+            stamp = current
+            changed.set()
+
+async def watchLoop(con, interval, output):
+    import asyncio
+    changed = asyncio.Event()
+    poller = asyncio.create_task(watchDbChanges(changed, min(interval, 2)))
+    out = None
+    counter = None
+    try:
+        while True:
+            now = datetime.now()
+            if counter is None or changed.is_set() or counter.day != now.date():
+                changed.clear()
+                counter = TodayCounter(con)
+
+            if out is None:
+                # opening a FIFO blocks until there is a reader
+                out = sys.stdout if output is None else open(output, 'w')
+            try:
+                out.write(counter.line(now) + "\n")
+                out.flush()
+            except BrokenPipeError:
+                if out is sys.stdout:
+                    raise
+                # the reader went away, wait for the next one
+                try:
+                    out.close()
+                except BrokenPipeError:
+                    pass
+                out = None
+                continue
+
+            # sleep until the next full interval or a database change
+            timeout = interval - now.timestamp() % interval
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        poller.cancel()
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+def watchToday(con, interval=60, output=None):
+    """
+    Print today's worktime every interval seconds, e.g. for a status bar,
+    to stdout or the file/FIFO output. Today's entries are read once and
+    again only after the database changed.
+    """
+    if interval <= 0:
+        error("Interval must be positive", None)
+    # asyncio takes longer to import than a punch command takes to run
+    import asyncio
+    asyncio.run(watchLoop(con, interval, output))
+
+def iterWorkDays(con, firstDay, lastDay):
+    """
+    Yield (WorkDay, hasEntries) for every day from firstDay to lastDay, loading
+    the entries one month at a time.
+    """
+    expected = expectedHours(con)
+    chunkStart = firstDay
+    while chunkStart <= lastDay:
+        chunkEnd = min(lastDay, lastDayOfMonth(chunkStart.year, chunkStart.month))
+        for d, rows in loadEntries(con, chunkStart, chunkEnd).items():
+            yield replayDay(d, rows, expected), len(dayEntries(rows)) > 0
+        chunkStart = chunkEnd + timedelta(days=1)
+
+EXPORT_DAY_FIELDS = ['date', 'type', 'start', 'end', 'pauses', 'worktime']
+EXPORT_MONTH_FIELDS = ['month', 'days', 'expected_workdays', 'expected',
+                       'actual', 'delta']
+
+def dayRecords(con, firstDay, lastDay):
+    minute = timedelta(minutes=1)
+    for workday, hasEntries in iterWorkDays(con, firstDay, lastDay):
+        yield {
+            'date': workday.day().isoformat(),
+            'type': workday.type.name.lower(),
+            'start': workday.start.isoformat() if hasEntries else '',
+            'end': workday.end.isoformat() if workday.is_finished() else '',
+            'pauses': ",".join("{:%H:%M}-{:%H:%M}".format(p.start, p.end)
+                               for p in workday.pauses),
+            'worktime': workday.worktime() // minute,
+        }
+
+def monthRecords(con, firstDay, lastDay):
+    minute = timedelta(minutes=1)
+    month = date(max(firstDay, THE_START).year, max(firstDay, THE_START).month, 1)
+    while month <= lastDay:
+        m = cachedMonthStats(con, month.month, month.year)
+        yield {
+            'month': m.date.strftime("%Y-%m"),
+            'days': m.numDays(),
+            'expected_workdays': m.expectedWorkdays,
+            'expected': m.expectedTime // minute,
+            'actual': m.actualTime // minute,
+            'delta': m.delta() // minute,
+        }
+        month = lastDayOfMonth(month.year, month.month) + timedelta(days=1)
+
+def exportRecords(con, start, end, format='csv', months=False, output=None):
+    """
+    Stream the days (or months) from start to end as CSV or JSONL to output,
+    stdout by default. Times are given in minutes.
+    """
+    firstDay = cleanedDate(start)
+    lastDay = cleanedDate(end)
+    if months:
+        records, fields = monthRecords(con, firstDay, lastDay), EXPORT_MONTH_FIELDS
+    else:
+        records, fields = dayRecords(con, firstDay, lastDay), EXPORT_DAY_FIELDS
+
+    if output is None or output == '-':
+        out = sys.stdout
+    else:
+        try:
+            out = open(output, 'w', newline='')
+        except OSError as e:
+            error("Cannot open {}".format(output), e)
+
+    try:
+        if format == 'csv':
+            import csv
+            writer = csv.DictWriter(out, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            import json
+            for record in records:
+                out.write(json.dumps(record))
+                out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
 def time_mod(time, delta, epoch=None):
     if epoch is None:
         epoch = datetime(1970, 1, 1, tzinfo=time.tzinfo)
@@ -783,7 +2433,21 @@ def validateConfig(config):
     if not (os.path.exists(config['db']['file']) or os.access(os.path.dirname(config['db']['file']), os.W_OK)):
         error("invalid db file or path not writeable", None)
 
-def main():
+# Commands taking no arguments which main() dispatches without building the
+# argument parser
+PUNCH_ACTIONS = {
+    'morning':  startTracking,
+    'start':    startTracking,
+    'break':    suspendTracking,
+    'pause':    suspendTracking,
+    'resume':   resumeTracking,
+    'continue': resumeTracking,
+    'closing':  endTracking,
+    'stop':     endTracking,
+    'end':      endTracking
+}
+
+def readConfig():
     try:
         cfgfile = os.path.expanduser(CONFIG_FILE)
         cfg.read(cfgfile)
@@ -793,37 +2457,59 @@ def main():
 
     validateConfig(cfg)
 
+    if cfg.has_option('calendar', 'cache'):
+        holiday_calendar.cacheFile = os.path.expanduser(cfg['calendar']['cache'])
+
+def buildParser():
+    import argparse
+
     parser = argparse.ArgumentParser(description='Track your work time')
+    parser.add_argument('--profile', action='store_const', const='1',
+                        help='Print SQL statistics to stderr, same as '
+                            'TIMETRACK_PROFILE=1')
+    parser.add_argument('--profile-dump', dest='profile', metavar='FILE',
+                        help='Like --profile, and write a cProfile dump to '
+                            'FILE, same as TIMETRACK_PROFILE=FILE')
 
     commands = parser.add_subparsers(title='subcommands', dest='action',
                                     help='description', metavar='action')
-    parser_morning = commands.add_parser('morning',
+
+    # options every subcommand takes
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--user', default=None,
+                        help='Whose entries to work on, defaults to "[db] '
+                            'user" from the config')
+
+    def addCommand(name, **kwargs):
+        return commands.add_parser(name, parents=[common], **kwargs)
+
+    parser_morning = addCommand('morning',
                                         help='Start a new day')
-    commands.add_parser('start', help='Start a new day')
+    addCommand('start', help='Start a new day')
 
-    parser_break = commands.add_parser('break',
+    parser_break = addCommand('break',
                                     help='Take a break from working')
-    commands.add_parser('pause', help='Alias to break')
+    addCommand('pause', help='Alias to break')
 
-    parser_resume = commands.add_parser('resume',
+    parser_resume = addCommand('resume',
                                         help='Resume working')
-    parser_continue = commands.add_parser('continue',
+    parser_continue = addCommand('continue',
                                         help='Resume working, alias of "resume"')
-    parser_closing = commands.add_parser('closing',
+    parser_closing = addCommand('closing',
                                         help='End your work day')
-    commands.add_parser('end', help='End your work day')
-    commands.add_parser('stop', help='End your work day')
-    parser_day = commands.add_parser('day',
+    addCommand('end', help='End your work day')
+    addCommand('stop', help='End your work day')
+    parser_day = addCommand('day',
                                     help='Print daily statistics')
     parser_day.add_argument('offset', nargs='?', default=0, type=int,
                             help='Offset in days to the current one to analyze. '
                                 'Note only negative values make sense here.')
-    parser_week = commands.add_parser('week',
+    parser_week = addCommand('week',
                                     help='Print weekly statistics')
     parser_week.add_argument('offset', nargs='?', default=0, type=int,
                             help='Offset in weeks to the current one to analyze. '
                                 'Note only negative values make sense here.')
-    parser_month = commands.add_parser('month',
+    parser_month = addCommand('month',
                                     help='Print monthly statistics')
     parser_month.add_argument('month', nargs='?', default=date.today().month, type=int,
                             help='Month (1-12), defaults to current')
@@ -836,7 +2522,7 @@ def main():
     parser_month.add_argument('--as-fract-hours', dest='as_hours', action='store_true',
                             help='Report work time as fractional hours instead of hours:minutes')
 
-    parser_year = commands.add_parser('year',
+    parser_year = addCommand('year',
                                     help='Print yearly statistics')
     parser_year.add_argument('year', nargs='?', default=date.today().year, type=int,
                             help='Year (YYYY), defaults to current')
@@ -844,36 +2530,161 @@ def main():
                             help='Month range end, defaults to '.format(date.today().month-1))
     parser_year.add_argument('fromMonth', nargs='?', default=1, type=int,
                             help='Month range start, defaults to 1')
+    parser_year.add_argument('--all-users', dest='all_users', action='store_true',
+                            help='Report every user of the database')
 
-    parser_total = commands.add_parser('total',
+    parser_total = addCommand('total',
                                     help='Print totally statistics')
     parser_total.add_argument('year', nargs='?', default=date.today().year, type=int,
                             help='Year (YYYY), defaults to current')
     parser_total.add_argument('toMonth', nargs='?', default=date.today().month-1, type=int,
                             help='Month range end, defaults to '.format(date.today().month-1))
-
-    parser_vacation = commands.add_parser('vacation',
+    parser_total.add_argument('--all-users', dest='all_users', action='store_true',
+                            help='Report every user of the database')
+
+    parser_range = addCommand('range',
+                                    help='Print statistics of any span of days')
+    parser_range.add_argument('start', type=valid_cli_date,
+                            help='First day (YYYY-MM-DD)')
+    parser_range.add_argument('end', type=valid_cli_date,
+                            help='Last day (YYYY-MM-DD)')
+    parser_range.add_argument('--all-users', dest='all_users', action='store_true',
+                            help='Report every user of the database')
+
+    parser_report = addCommand('report',
+                                    help='Print month or year reports, computed '
+                                        'in parallel')
+    parser_report.add_argument('month', nargs='?', default=date.today().month, type=int,
+                            help='Month (1-12), defaults to current')
+    parser_report.add_argument('year', nargs='?', default=date.today().year, type=int,
+                            help='Year (YYYY), defaults to current')
+    parser_report.add_argument('--all', dest='all_users', action='store_true',
+                            help='Report every user of the database')
+    parser_report.add_argument('--per', choices=['user', 'year'], default='user',
+                            help='One month report per user, or one report '
+                                'per year up to month/year')
+    parser_report.add_argument('--jobs', '-j', type=int, default=None,
+                            help='Number of worker processes, defaults to the '
+                                'number of CPUs')
+
+    parser_vacation = addCommand('vacation',
                                     help='Enter vacation dates')
     parser_vacation.add_argument('start', nargs='?', type=valid_cli_date,
                             help='Start of vacation')
     parser_vacation.add_argument('end', nargs='?', type=valid_cli_date,
                             help='End of vacation')
 
-    parser_fza = commands.add_parser('fza',
+    parser_fza = addCommand('fza',
                                     help='Enter fza dates')
     parser_fza.add_argument('start', nargs='?', type=valid_cli_date,
                             help='Start of fza')
     parser_fza.add_argument('end', nargs='?', type=valid_cli_date,
                             help='End of fza')
 
-    parser_sick = commands.add_parser('sick',
+    parser_sick = addCommand('sick',
                                     help='Enter sick dates')
     parser_sick.add_argument('start', nargs='?', type=valid_cli_date,
                             help='Start of sick')
     parser_sick.add_argument('end', nargs='?', type=valid_cli_date,
                             help='End of sick')
 
-    args = parser.parse_args()
+    parser_import = addCommand('import',
+                                    help='Import entries from a CSV or JSONL file')
+    parser_import.add_argument('file',
+                            help='File with (type, ts) records, - for stdin')
+    parser_import.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                            help='File format, guessed from the file name by default')
+    parser_import.add_argument('--conflict', choices=list(INSERT_CONFLICT),
+                            default='ignore',
+                            help='What to do with entries already recorded, '
+                                'defaults to ignore. abort only rolls back '
+                                'the current chunk.')
+    parser_import.add_argument('--chunk-size', dest='chunk_size', type=int,
+                            default=1000,
+                            help='Number of entries per transaction')
+
+    parser_export = addCommand('export',
+                                    help='Export days or months as CSV or JSONL')
+    parser_export.add_argument('start', type=valid_cli_date,
+                            help='First day to export (YYYY-MM-DD)')
+    parser_export.add_argument('end', type=valid_cli_date,
+                            help='Last day to export (YYYY-MM-DD)')
+    parser_export.add_argument('--format', choices=['csv', 'jsonl'], default='csv',
+                            help='Output format, defaults to csv')
+    parser_export.add_argument('--months', action='store_true',
+                            help='Export monthly aggregates instead of days')
+    parser_export.add_argument('--output', '-o', default=None,
+                            help='Output file, defaults to stdout')
+
+    parser_check = addCommand('check',
+                                    help='List inconsistent entries')
+    parser_check.add_argument('start', nargs='?', type=valid_cli_date,
+                            help='First day to check, defaults to the first entry')
+    parser_check.add_argument('end', nargs='?', type=valid_cli_date,
+                            help='Last day to check, defaults to the last entry')
+
+    parser_schedule = addCommand('schedule',
+                                    help='Show or change the weekly hours')
+    parser_schedule.add_argument('since', nargs='?', type=valid_cli_date,
+                            help='First day of the change (YYYY-MM-DD)')
+    parser_schedule.add_argument('hours', nargs='?', type=float,
+                            help='Weekly hours from that day on')
+    parser_schedule.add_argument('--remove', action='store_true',
+                            help='Remove the change starting at SINCE')
+
+    parser_watch = addCommand('watch',
+                                    help='Continuously print today\'s work time')
+    parser_watch.add_argument('--interval', type=int, default=60,
+                            help='Seconds between two lines, defaults to 60')
+    parser_watch.add_argument('--output', '-o', default=None,
+                            help='File or FIFO to write to, defaults to stdout')
+
+    addCommand('serve',
+                        help='Run as daemon serving the other commands on a '
+                            'local socket')
+
+    return parser
+
+# commands that only read, run on dbOpenReport() connections
+REPORT_HANDLERS = {dayStatistics, weekStatistics, printMonthStats,
+                   printYearlyStats, printTotalStats, printRangeStats,
+                   printReports, exportRecords, checkEntries}
+
+def runAction(handler, extraArgs, profile=None, user=None):
+    """
+    Run handler on a fresh connection for user and exit, a read-only one for
+    the REPORT_HANDLERS. With profile set, SQL statistics are printed to
+    stderr afterwards; unless profile is just "1", it names a file to write a
+    cProfile dump of the handler to.
+    """
+    global connectionFactory
+    try:
+        if profile:
+            import sqlprofile
+            connectionFactory = sqlprofile.profilingConnection(Connection)
+        connect = dbOpenReport if handler in REPORT_HANDLERS else dbSetup
+        connection = connect(user)
+        if profile:
+            sqlprofile.run(handler, connection, extraArgs,
+                           None if profile == '1' else profile)
+        else:
+            handler(connection, **extraArgs)
+        sys.exit(0)
+    except ProgramAbortError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt as e:
+        print()
+        sys.exit(255)
+
+def parseCommand(argv):
+    """
+    Parse the command line argv (without the program name). Returns the
+    handler, its extra arguments, the profile setting and the user for
+    runAction().
+    """
+    parser = buildParser()
+    args = parser.parse_args(argv)
 
     actions = {
         'morning':  (startTracking, []),
@@ -885,14 +2696,22 @@ def main():
         'day':      (dayStatistics, ['offset']),
         'week':     (weekStatistics, ['offset']),
         'month':     (printMonthStats, ['month', 'year', 'with_total', 'with_ytd', 'as_hours']),
-        'year':     (printYearlyStats, ['year', 'toMonth', 'fromMonth']),
-        'total':     (printTotalStats, ['year', 'toMonth']),
+        'year':     (printYearlyStats, ['year', 'toMonth', 'fromMonth', 'all_users']),
+        'total':     (printTotalStats, ['year', 'toMonth', 'all_users']),
+        'range':    (printRangeStats, ['start', 'end', 'all_users']),
+        'report':   (printReports, ['month', 'year', 'all_users', 'per', 'jobs']),
         'vacation': (addVacation, ['start', 'end']),
         'fza': (addFza, ['start', 'end']),
         'sick': (addSick, ['start', 'end']),
+        'import': (importEntries, ['file', 'format', 'conflict', 'chunk_size']),
+        'export': (exportRecords, ['start', 'end', 'format', 'months', 'output']),
         'closing':  (endTracking, []),
         'stop':  (endTracking, []),
-        'end':  (endTracking, [])
+        'end':  (endTracking, []),
+        'check': (checkEntries, ['start', 'end']),
+        'schedule': (editSchedule, ['since', 'hours', 'remove']),
+        'watch': (watchToday, ['interval', 'output']),
+        'serve': (serveDaemon, []),
     }
 
     if not args.action:
@@ -904,23 +2723,190 @@ def main():
                 .format(args.action), file=sys.stderr)
         sys.exit(1)
 
+    extraArgs = {}
+    handler, extraArgNames = actions[args.action]
+    for extraArgName in extraArgNames:
+        if extraArgName in args:
+            extraArgs[extraArgName] = getattr(args, extraArgName)
+
+    return (handler, extraArgs,
+            args.profile or os.environ.get('TIMETRACK_PROFILE'), args.user)
+
+# Commands the client hands to a running daemon. Everything else reads or
+# writes files relative to the client or asks questions.
+DAEMON_ACTIONS = set(PUNCH_ACTIONS) | {'day', 'week', 'month', 'year', 'total',
+                                       'range'}
+
+def daemonSocket():
+    if cfg.has_option('daemon', 'socket'):
+        return os.path.expanduser(cfg['daemon']['socket'])
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtimeDir:
+        return os.path.join(runtimeDir, 'timetrack.sock')
+    return "/tmp/timetrack-{}.sock".format(os.getuid())
+
+def ownSocket(path):
+    """
+    Whether path is a Unix domain socket of the current user. Anybody could
+    create the one in /tmp first and answer in place of the daemon.
+    """
+    import stat
     try:
-        connection = dbSetup()
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
 
-        extraArgs = {}
-        handler, extraArgNames = actions[args.action]
-        for extraArgName in extraArgNames:
-            if extraArgName in args:
-                extraArgs[extraArgName] = getattr(args, extraArgName)
+def runViaDaemon(argv):
+    """
+    Run the command in a running 'timetrack serve' daemon and return its exit
+    code, or None if there is no daemon or the command has to run locally.
+    A daemon not answering within "[daemon] timeout" seconds is an error, the
+    command may have run already.
+    """
+    path = daemonSocket()
+    if not ownSocket(path):
+        return None
 
-        handler(connection, **extraArgs)
-        sys.exit(0)
-    except ProgramAbortError as e:
-        print(str(e), file=sys.stderr)
-        sys.exit(1)
-    except KeyboardInterrupt as e:
-        print()
-        sys.exit(255)
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(cfg.getfloat('daemon', 'timeout', fallback=30))
+    try:
+        sock.connect(path)
+    except OSError:
+        # stale socket
+        sock.close()
+        return None
+
+    try:
+        with sock, sock.makefile('rwb') as f:
+            f.write(json.dumps({'argv': argv}).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+    except socket.timeout:
+        print("No answer from the daemon on {}, set TIMETRACK_NO_DAEMON=1 to "
+              "run without it".format(path), file=sys.stderr)
+        return 1
+    if not line:
+        return None
+
+    response = json.loads(line)
+    if response.get('local'):
+        return None
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['code']
+
+def serveCommand(con, argv):
+    """
+    Run a command for a daemon client with its output captured. Returns the
+    response to send.
+    """
+    import contextlib
+    import io
+    import traceback
+
+    out = io.StringIO()
+    err = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            handler, extraArgs, profile, user = parseCommand(argv)
+            if profile or handler is serveDaemon:
+                return {'local': True}
+            con.user = defaultUser() if user is None else user
+            handler(con, **extraArgs)
+        except NeedsTerminal:
+            con.rollback()
+            return {'local': True}
+        except ProgramAbortError as e:
+            print(str(e), file=sys.stderr)
+            code = 1
+        except SystemExit as e:
+            # argparse errors and --help
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            con.rollback()
+            traceback.print_exc()
+            code = 1
+    return {'stdout': out.getvalue(), 'stderr': err.getvalue(), 'code': code}
+
+def serveDaemon(con):
+    """
+    Serve commands from clients on a Unix domain socket, keeping the database
+    connection, calendar and today's state in memory between commands.
+    """
+    global serving
+    import json
+    import signal
+    import socket
+    import socketserver
+
+    path = daemonSocket()
+    if os.path.lexists(path):
+        if not ownSocket(path):
+            error("{} exists and is not a socket of yours".format(path), None)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            error("Daemon already running on {}".format(path), None)
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                # probe from another "serve"
+                return
+            try:
+                request = json.loads(line)
+                response = serveCommand(con, request['argv'])
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'stdout': '', 'stderr': "Bad request: {}\n".format(e),
+                            'code': 1}
+            try:
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+            except BrokenPipeError:
+                pass
+
+    # the socket must only be accessible by its owner
+    oldUmask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(oldUmask)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serving = True
+    message("Serving on {}".format(path))
+    try:
+        server.serve_forever()
+    finally:
+        serving = False
+        server.server_close()
+        os.unlink(path)
+
+def main():
+    readConfig()
+
+    argv = sys.argv[1:]
+    if (argv and argv[0] in DAEMON_ACTIONS and
+            not os.environ.get('TIMETRACK_PROFILE') and
+            not os.environ.get('TIMETRACK_NO_DAEMON')):
+        code = runViaDaemon(argv)
+        if code is not None:
+            sys.exit(code)
+
+    if len(argv) == 1 and argv[0] in PUNCH_ACTIONS:
+        # fast path for the punch commands
+        runAction(PUNCH_ACTIONS[argv[0]], {},
+                  os.environ.get('TIMETRACK_PROFILE'))
+
+    runAction(*parseCommand(argv))
 
 if __name__ == "__main__":
     main()